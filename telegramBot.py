@@ -1,6 +1,9 @@
+import asyncio
 import logging
 import os
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -12,8 +15,15 @@ from telegram.ext import (
 )
 import google.generativeai as genai
 from dotenv import load_dotenv
-import tempfile
-from gradio_client import Client
+
+# Share the backend helpers that live in the Django app
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "telegramOAHelper"))
+from TelegramBot.albums import AlbumBuffer, AlbumPhoto
+from TelegramBot.backends import GeminiBackend, GradioBackend
+from TelegramBot.gradio_pool import GradioPool, JobSuperseded, describe_status
+from TelegramBot.chunker import chunk_markdown
+from TelegramBot.helpers import buffer_album_photo, button_handler, start, upload_photo
+
 MAX_MESSAGE_LENGTH = 4000
 
 # Load environment variables from .env file
@@ -38,178 +48,134 @@ models = {
     "ChatGPT4": "ChatGPT4",
 }
 
-# Function to handle /start command and show model selection
-
-def split_message(text, max_length):
-    return [text[i:i + max_length] for i in range(0, len(text), max_length)]
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("Use o1", callback_data="o1")],
-        [InlineKeyboardButton("Use o1mini", callback_data="o1mini")],
-        [InlineKeyboardButton("Use ChatGPT4", callback_data="ChatGPT4")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    await update.message.reply_text(
-        "Choose the model you want to use to process the image analysis output:",
-        reply_markup=reply_markup,
-    )
-
-# Function to handle model selection
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+# Concurrency settings
+#
+# BOT_CONCURRENT_UPDATES: how many Telegram updates are handled at the same
+#     time. Handlers mostly wait on the network, so this can be generous.
+# BOT_PIPELINE_WORKERS: how many images are processed at the same time. It
+#     also sizes the default thread pool that runs the blocking GenAI calls,
+#     so raise it together with the upstream rate limits.
+CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
+PIPELINE_WORKERS = int(os.getenv("BOT_PIPELINE_WORKERS", "8"))
 
-    selected_model = query.data
-    context.user_data["selected_model"] = selected_model
+executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+pipeline_slots = asyncio.Semaphore(PIPELINE_WORKERS)
 
-    if selected_model in models:
-        await query.edit_message_text(
-            f"You selected {selected_model}. Please upload an image for analysis."
-        )
-    else:
-        await query.edit_message_text("Model selection failed!")
 
-# Helper function to handle image file upload to GenAI
-async def upload_image_to_genai(file):
-    # Create a temporary file and close it immediately
-    fd, temp_file_path = tempfile.mkstemp(suffix=".jpg")
-    os.close(fd)  # Close the file descriptor to prevent the file from being held open
+# Warm Gradio clients for the yuntian-deng Spaces, shared by all users
+gradio_pool = GradioPool(max_idle_per_space=PIPELINE_WORKERS)
+answer_backend = GradioBackend(gradio_pool)
+extraction_backend = GeminiBackend()
 
-    try:
-        await file.download_to_drive(temp_file_path)
-
-        # Upload the file to GenAI using the temporary file path
-        sample_file = genai.upload_file(
-            path=temp_file_path, display_name="Uploaded Image"
-        )
-        logging.info(
-            f"Uploaded file '{sample_file.display_name}' as: {sample_file.uri}"
-        )
-        return sample_file
-    finally:
-        # Clean up: remove the temporary file after the operation
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+# Photos of albums that are still arriving, shared by all chats
+album_buffer = AlbumBuffer()
 
 # Function to process images (single or multiple)
-async def process_images(context, messages, selected_model, chat_id):
+async def process_images(context, photos, selected_model, chat_id, user_id=None):
     # Send status message to the user
     status_message = await context.bot.send_message(
         chat_id=chat_id,
         text="Processing your image(s) with the Gemini model..."
     )
 
-    uploaded_files = []
-    for message in messages:
-        photos = message.photo
-        photo = photos[-1]  # Get the highest resolution photo
-        file = await context.bot.get_file(photo.file_id)
-        uploaded_file = await upload_image_to_genai(file)
-        uploaded_files.append(uploaded_file)
+    # Only a bounded number of pipelines run at once; the rest wait their turn here
+    if pipeline_slots.locked():
+        await status_message.edit_text("All workers are busy, your image(s) are queued...")
+    async with pipeline_slots:
+        await run_pipeline(context, photos, selected_model, chat_id, user_id, status_message)
+
+async def run_pipeline(context, photos, selected_model, chat_id, user_id, status_message):
+    # Upload every photo of the album concurrently
+    uploaded_files = await asyncio.gather(*(
+        upload_photo(context.bot, photo.file_id) for photo in photos
+    ))
 
     # Use the Gemini model for analysis
-    model = genai.GenerativeModel(model_name="gemini-1.5-pro-latest")
     prompt = "return whatever is written in the image,basically perform ocr of all images"
-    response = model.generate_content([prompt] + uploaded_files)
-    gemini_output = response.text  # Adjust according to actual response format
-    print(gemini_output)
+    extraction = await extraction_backend.answer(
+        [{"role": "user", "content": [prompt] + list(uploaded_files)}], "gemini-1.5-pro-latest"
+    )
+    gemini_output = extraction.text
+    logging.debug(gemini_output)
     # Update status message
     await status_message.edit_text(
         f"Processing the Gemini output with the {selected_model} model..."
     )
 
-    # Use Gradio client to process the Gemini output with the selected model
-    client = Client(f"yuntian-deng/{selected_model}")
-    result = client.predict(
-        inputs=gemini_output + "explain whatever is written",
-        top_p=1,
-        temperature=1,
-        chat_counter=0,
-        chatbot=[],
-        api_name="/predict",
-    )
-    message_text = result[0][0][1]  # Limit the message text to the first 4000 characters
-    # Send the final result back to the user
-    message_chunks = split_message(message_text, MAX_MESSAGE_LENGTH)
+    # Show the user where they are in the Space's queue while the job waits. The
+    # pool polls every second; Telegram rejects edits that change nothing.
+    shown_status = None
+
+    async def report_queue_status(status):
+        nonlocal shown_status
+        text = describe_status(status)
+        if text and text != shown_status:
+            shown_status = text
+            await status_message.edit_text(text)
 
-    # Send each chunk as a separate message
-    for chunk in message_chunks:
+    # Use Gradio client to process the Gemini output with the selected model.
+    # The same user re-sending the same image(s) cancels this job if it is still queued.
+    owner = (chat_id, user_id, tuple(photo.file_unique_id for photo in photos))
+    try:
+        answer = await answer_backend.answer(
+            [{"role": "user", "content": gemini_output + "explain whatever is written"}],
+            f"yuntian-deng/{selected_model}",
+            owner=owner,
+            on_status=report_queue_status,
+        )
+    except JobSuperseded:
+        await status_message.edit_text("Cancelled because you sent the same image(s) again.")
+        return
+    message_text = answer.text
+    # Send the final result back to the user, split on line and paragraph boundaries
+    header = f"Final Result from {selected_model} model:\n"
+    message_chunks = chunk_markdown(message_text, MAX_MESSAGE_LENGTH - len(header))
+
+    # Send each chunk as a separate message; this bot sends plain text
+    for _, chunk in message_chunks:
         await context.bot.send_message(
             chat_id=chat_id,
-            text=f"Final Result from {selected_model} model:\n{chunk}",
+            text=header + chunk,
         )
 
 
 # Function to handle image uploads
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if "selected_model" not in context.user_data:
+    if context.chat_data.get("selected_model") not in models:
         await update.message.reply_text(
             "Please select a model first using the /start command."
         )
         return
 
-    selected_model = context.user_data["selected_model"]
+    selected_model = context.chat_data["selected_model"]
 
     chat_id = update.effective_chat.id
-
-    # Initialize media_groups and media_group_jobs in context.chat_data if not present
-    if 'media_groups' not in context.chat_data:
-        context.chat_data['media_groups'] = {}
-    if 'media_group_jobs' not in context.chat_data:
-        context.chat_data['media_group_jobs'] = {}
+    user_id = update.effective_user.id if update.effective_user else None
+    photo = AlbumPhoto.from_photo_size(update.message.photo[-1])  # Get the highest resolution photo
 
     media_group_id = update.message.media_group_id
 
     if media_group_id:
-        # This message is part of a media group
-        if media_group_id not in context.chat_data['media_groups']:
-            context.chat_data['media_groups'][media_group_id] = []
-        # Store the message
-        context.chat_data['media_groups'][media_group_id].append(update.message)
-
-        # Cancel any existing job for this media_group_id
-        if media_group_id in context.chat_data['media_group_jobs']:
-            context.chat_data['media_group_jobs'][media_group_id].schedule_removal()
-
-        # Schedule a new job to process this media group after 2 seconds
-        job = context.application.job_queue.run_once(
-            process_media_group,
-            when=2,  # seconds
-            chat_id=chat_id,
-            data={
-                'media_group_id': media_group_id,
-                'selected_model': selected_model,
-            }
-        )
-        # Store the job so we can cancel/reschedule it if needed
-        context.chat_data['media_group_jobs'][media_group_id] = job
+        # This message is part of a media group, processed once the album goes quiet
+        buffer_album_photo(context, album_buffer, process_media_group, photo, chat_id, user_id, media_group_id)
     else:
         # Single image, process it immediately
-        await process_images(
-            context, [update.message], selected_model, update.effective_chat.id
-        )
+        await process_images(context, [photo], selected_model, chat_id, user_id)
 
 # Function to process media group after waiting
 async def process_media_group(context: CallbackContext):
-    job_data = context.job.data
-    media_group_id = job_data['media_group_id']
-    selected_model = job_data['selected_model']
-    chat_id = context.job.chat_id
-
-    # Retrieve the stored messages (photos)
-    chat_data = context.application.chat_data.get(chat_id, {})
-    media_groups = chat_data.get('media_groups', {})
-    messages = media_groups.pop(media_group_id, [])
-
-    # Remove the job from media_group_jobs
-    media_group_jobs = chat_data.get('media_group_jobs', {})
-    media_group_jobs.pop(media_group_id, None)
-
-    if messages:
-        await process_images(
-            context, messages, selected_model, chat_id=chat_id
-        )
+    album = album_buffer.pop(context.job.data)
+    if not album or not album.photos:
+        return
+
+    # The chat's current choice, in case it changed while the album was arriving
+    selected_model = context.application.chat_data[album.chat_id].get("selected_model")
+    if selected_model not in models:
+        return
+
+    await process_images(
+        context, album.photos, selected_model, chat_id=album.chat_id, user_id=album.user_id
+    )
 
 # Main function to run the bot
 if __name__ == "__main__":
@@ -219,7 +185,24 @@ if __name__ == "__main__":
             "GOOGLE_API_KEY or TELEGRAM_BOT_TOKEN is not set in the environment."
         )
 
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    # Run blocking calls on the bounded worker pool and open a Gradio client
+    # per model Space before the first user needs it
+    async def post_init(application):
+        asyncio.get_running_loop().set_default_executor(executor)
+        for selected_model in models:
+            try:
+                await gradio_pool.warm(f"yuntian-deng/{selected_model}")
+            except Exception as e:
+                logging.error(f"Could not warm Gradio client for {selected_model}: {e}")
+
+    # Handle updates from different users concurrently instead of one at a time
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .build()
+    )
 
     # Command to start the bot and show model selection
     application.add_handler(CommandHandler("start", start))
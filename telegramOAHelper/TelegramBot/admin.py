@@ -1,3 +1,21 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import Answer, Checkpoint, Extraction
+
+
+@admin.register(Extraction)
+class ExtractionAdmin(admin.ModelAdmin):
+    list_display = ("image_hash", "chat_id", "created_at")
+    search_fields = ("image_hash",)
+
+
+@admin.register(Answer)
+class AnswerAdmin(admin.ModelAdmin):
+    list_display = ("question_number", "model", "chat_id", "delivered", "created_at")
+    list_filter = ("model", "delivered")
+    search_fields = ("question_text",)
+
+
+@admin.register(Checkpoint)
+class CheckpointAdmin(admin.ModelAdmin):
+    list_display = ("chat_id", "model", "created_at")
@@ -0,0 +1,104 @@
+# bot_app/albums.py
+
+import logging
+import sys
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+class AlbumPhoto(NamedTuple):
+    """The only parts of a Telegram photo the pipeline needs."""
+    file_id: str
+    file_unique_id: str
+    file_size: int
+
+    @classmethod
+    def from_photo_size(cls, photo):
+        return cls(photo.file_id, photo.file_unique_id, photo.file_size or 0)
+
+
+class Album:
+    __slots__ = ("chat_id", "user_id", "photos", "created", "updated", "job")
+
+    def __init__(self, chat_id, user_id):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.photos = []
+        self.created = self.updated = time.monotonic()
+        self.job = None
+
+
+class AlbumBuffer:
+    """Bounded buffer for media groups that are still arriving.
+
+    Telegram delivers an album as separate updates, so photos are collected
+    here until the album goes quiet. The buffer is shared by all chats and
+    capped both in size and in age: an album whose flush job never fired is
+    evicted instead of living in memory forever.
+    """
+
+    def __init__(self, max_albums=1000, max_photos_per_album=10, max_age=120):
+        self.max_albums = max_albums
+        self.max_photos_per_album = max_photos_per_album
+        self.max_age = max_age
+        self._albums = OrderedDict()  # (chat_id, media_group_id) -> Album, least recently updated first
+        self.evicted = 0
+
+    def add(self, key, chat_id, user_id, photo):
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = Album(chat_id, user_id)
+            while len(self._albums) > self.max_albums:
+                self._evict(next(iter(self._albums)), "buffer full")
+        else:
+            self._albums.move_to_end(key)
+
+        if len(album.photos) < self.max_photos_per_album:
+            album.photos.append(photo)
+        else:
+            logging.warning(f"Dropping photo for album {key}: more than {self.max_photos_per_album} photos")
+        album.updated = time.monotonic()
+        return album
+
+    def pop(self, key):
+        return self._albums.pop(key, None)
+
+    # Hand over every buffered album, e.g. when the process is shutting down
+    def drain(self):
+        albums = list(self._albums.values())
+        self._albums.clear()
+        return albums
+
+    def _evict(self, key, reason):
+        album = self._albums.pop(key)
+        if album.job is not None:
+            album.job.schedule_removal()
+        self.evicted += 1
+        logging.warning(f"Evicted album {key} with {len(album.photos)} photo(s): {reason}")
+
+    def sweep(self):
+        """Evict albums that have not been updated within ``max_age`` seconds."""
+        cutoff = time.monotonic() - self.max_age
+        while self._albums:
+            key, album = next(iter(self._albums.items()))
+            if album.updated > cutoff:
+                break
+            self._evict(key, "expired")
+
+    def stats(self):
+        albums = self._albums.values()
+        size = sys.getsizeof(self._albums)
+        for album in albums:
+            size += sys.getsizeof(album) + sys.getsizeof(album.photos)
+            for photo in album.photos:
+                size += sys.getsizeof(photo) + sys.getsizeof(photo.file_id) + sys.getsizeof(photo.file_unique_id)
+        return {
+            "albums": len(self._albums),
+            "photos": sum(len(album.photos) for album in albums),
+            "bytes": size,
+            "evicted": self.evicted,
+        }
+
+    def __len__(self):
+        return len(self._albums)
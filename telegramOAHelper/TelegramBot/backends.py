@@ -0,0 +1,209 @@
+# bot_app/backends.py
+
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import NamedTuple, Optional
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+import openai
+
+
+class Usage(NamedTuple):
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    cached_tokens: int = 0
+
+
+class Answer(NamedTuple):
+    text: str
+    usage: Optional[Usage] = None
+
+
+class LatencyStats:
+    """Rolling latency figures for one backend."""
+
+    def __init__(self, window=500):
+        self.samples = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, seconds, ok=True):
+        self.calls += 1
+        if not ok:
+            self.errors += 1
+        self.samples.append(seconds)
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def summary(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+        }
+
+
+class AnswerBackend(ABC):
+    """Common interface for the services that answer extracted questions.
+
+    ``messages`` are chat-style ``{"role", "content"}`` dicts as produced by
+    the prompt templates. Backends that cannot take a system prompt fold it
+    into the user message themselves. Backends with ``supports_images`` also
+    accept a list of text and uploaded files as a message's content.
+    """
+
+    name = None
+    provider = None  # key used for rate limiting
+    rate_limit_errors = ()
+
+    # Capability flags
+    supports_streaming = False
+    supports_system_prompt = False
+    supports_images = False
+    reports_usage = False
+    reports_queue_status = False
+
+    def __init__(self):
+        self.stats = LatencyStats()
+
+    async def answer(self, messages, model, **options):
+        start = time.perf_counter()
+        ok = False
+        try:
+            answer = await self._answer(messages, model, **options)
+            ok = True
+            return answer
+        finally:
+            self.stats.record(time.perf_counter() - start, ok)
+            logging.debug(f"{self.name} backend latency: {self.stats.summary()}")
+
+    async def stream(self, messages, model, **options):
+        """Yield the answer text in pieces; backends without streaming yield it whole."""
+        answer = await self.answer(messages, model, **options)
+        yield answer.text
+
+    @abstractmethod
+    async def _answer(self, messages, model, **options):
+        """Call the service and return an ``Answer``."""
+
+    # Helper function for backends that only take a single prompt string
+    @staticmethod
+    def flatten(messages):
+        return "\n\n".join(message["content"] for message in messages)
+
+
+class OpenAIBackend(AnswerBackend):
+    name = "openai"
+    provider = "openai"
+    rate_limit_errors = (openai.RateLimitError,)
+    supports_streaming = True
+    supports_system_prompt = True
+    reports_usage = True
+
+    def __init__(self, api_key):
+        super().__init__()
+        # 429s are retried by RateBudget, which pauses every worker, not by the SDK
+        self.client = openai.AsyncOpenAI(api_key=api_key, max_retries=0)
+
+    @staticmethod
+    def _usage(usage):
+        if usage is None:
+            return None
+        details = getattr(usage, "prompt_tokens_details", None)
+        return Usage(
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+            total_tokens=usage.total_tokens,
+            cached_tokens=getattr(details, "cached_tokens", 0) or 0,
+        )
+
+    async def _answer(self, messages, model, **options):
+        completion = await self.client.chat.completions.create(
+            model=model, messages=messages, **options
+        )
+        return Answer(completion.choices[0].message.content, self._usage(completion.usage))
+
+    async def stream(self, messages, model, **options):
+        start = time.perf_counter()
+        ok = False
+        try:
+            response = await self.client.chat.completions.create(
+                model=model, messages=messages, stream=True, **options
+            )
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+            ok = True
+        finally:
+            self.stats.record(time.perf_counter() - start, ok)
+
+
+class GeminiBackend(AnswerBackend):
+    """Gemini models; also reads the photos for question extraction."""
+
+    name = "gemini"
+    provider = "gemini"
+    rate_limit_errors = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+    supports_system_prompt = True
+    supports_images = True
+    reports_usage = True
+
+    async def _answer(self, messages, model, **options):
+        system = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+        contents = []
+        for message in messages:
+            if message["role"] != "system":
+                content = message["content"]
+                contents.extend(content if isinstance(content, list) else [content])
+        generative_model = genai.GenerativeModel(model_name=model, system_instruction=system or None)
+
+        # The SDK call blocks, so run it in a separate thread
+        response = await asyncio.to_thread(generative_model.generate_content, contents, **options)
+
+        metadata = getattr(response, "usage_metadata", None)
+        usage = None
+        if metadata is not None:
+            usage = Usage(
+                prompt_tokens=metadata.prompt_token_count,
+                completion_tokens=metadata.candidates_token_count,
+                total_tokens=metadata.total_token_count,
+                cached_tokens=getattr(metadata, "cached_content_token_count", 0) or 0,
+            )
+        return Answer(response.text, usage)
+
+
+class GradioBackend(AnswerBackend):
+    """The free yuntian-deng chatbot Spaces; ``model`` is the Space name."""
+
+    name = "gradio"
+    provider = "gradio"
+    reports_queue_status = True
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    async def _answer(self, messages, model, owner=None, on_status=None, **options):
+        result = await self.pool.submit(
+            model,
+            owner=owner,
+            on_status=on_status,
+            inputs=self.flatten(messages),
+            top_p=options.get("top_p", 1),
+            temperature=options.get("temperature", 1),
+            chat_counter=0,
+            chatbot=[],
+            api_name="/predict",
+        )
+        # The Space returns the whole chat history; take the bot side of the first turn
+        return Answer(result[0][0][1])
@@ -0,0 +1,140 @@
+# bot_app/chunker.py
+
+import re
+
+FENCE = "```"
+MAX_LANGUAGE_LENGTH = 20  # a split code block is reopened with at most this much of its language
+
+# Telegram's legacy Markdown only knows these entity markers
+_WORD_UNDERSCORE = re.compile(r"(?<=\w)_(?=\w)")
+_LINK = re.compile(r"\[[^\[\]\n]*\]\([^()\s]*\)")
+
+
+def _is_fence_toggle(line):
+    # "```cpp" opens or closes a block, "```Answer: B```" is a one-line block
+    stripped = line.lstrip()
+    return stripped.startswith(FENCE) and stripped.count(FENCE) % 2 == 1
+
+
+def _fence_opener(line):
+    # Reopen a split block with "```lang" only, never the rest of a long opening line
+    info = line.strip()[len(FENCE):].split("`")[0].split()
+    return FENCE + (info[0][:MAX_LANGUAGE_LENGTH] if info else "")
+
+
+def _escape_marker(text, marker):
+    unescaped = re.compile(r"(?<!\\)" + re.escape(marker))
+    if len(unescaped.findall(text)) % 2:
+        return unescaped.sub(lambda match: "\\" + marker, text)
+    return text
+
+
+def _escape_text(text):
+    # Models write GitHub style **bold**, Telegram's Markdown wants *bold*
+    text = text.replace("**", "*")
+    text = _WORD_UNDERSCORE.sub(r"\\_", text)
+    text = _escape_marker(text, "*")
+    text = _escape_marker(text, "_")
+
+    # Escape stray brackets but leave [text](url) links alone
+    parts = []
+    last = 0
+    for link in _LINK.finditer(text):
+        parts.append(text[last:link.start()].replace("[", "\\["))
+        parts.append(link.group())
+        last = link.end()
+    parts.append(text[last:].replace("[", "\\["))
+    return "".join(parts)
+
+
+def escape_line(line):
+    """Escape one line of text that is outside a code block for Telegram's legacy Markdown."""
+    if "`" not in line:
+        return _escape_text(line)
+    if line.count("`") % 2:
+        # An unmatched backtick would swallow the rest of the message
+        return _escape_text(line).replace("`", "\\`")
+    # Leave inline code spans untouched; they sit at the odd positions
+    segments = line.split("`")
+    return "`".join(seg if i % 2 else _escape_text(seg) for i, seg in enumerate(segments))
+
+
+def _split_long_line(line, limit):
+    pieces = []
+    while len(line) > limit:
+        cut = line.rfind(" ", 0, limit)
+        if cut <= limit // 2:
+            cut = limit
+        pieces.append(line[:cut])
+        line = line[cut:].lstrip(" ")
+    pieces.append(line)
+    return pieces
+
+
+def chunk_markdown(text, max_length):
+    """Split ``text`` into ``(markdown, plain)`` chunks of at most ``max_length`` characters.
+
+    Chunks end on paragraph boundaries where possible and on line boundaries
+    otherwise. A code block that has to be split is closed at the end of one
+    chunk and reopened, with its language, at the start of the next. The
+    Markdown version is escaped for Telegram's legacy parser; the plain
+    version is the untouched text to fall back on if Telegram still rejects it.
+    """
+    chunks = []
+    markdown_lines, plain_lines = [], []
+    length = 0
+    open_fence = None
+    paragraph_break = None  # index just after the last blank line outside a code block
+
+    def flush(upto):
+        nonlocal markdown_lines, plain_lines, length, paragraph_break
+        markdown, plain = markdown_lines[:upto], plain_lines[:upto]
+        rest_markdown, rest_plain = markdown_lines[upto:], plain_lines[upto:]
+        if open_fence is not None and not rest_markdown:
+            markdown.append(FENCE)
+            plain.append(FENCE)
+        if any(line.strip() for line in markdown):
+            chunks.append(("\n".join(markdown).strip("\n"), "\n".join(plain).strip("\n")))
+
+        markdown_lines, plain_lines = rest_markdown, rest_plain
+        if open_fence is not None and not markdown_lines:
+            markdown_lines, plain_lines = [open_fence], [open_fence]
+        length = sum(len(line) + 1 for line in markdown_lines)
+        paragraph_break = None
+
+    fence_reserve = len(FENCE) + 1
+    for raw_line in text.split("\n"):
+        toggles = _is_fence_toggle(raw_line)
+        opener = _fence_opener(raw_line) if toggles and open_fence is None else None
+        # Keep room for closing and reopening a block; always allow some progress
+        limit = max(max_length - fence_reserve * 2 - len(open_fence or opener or ""), 1)
+
+        for line in _split_long_line(raw_line, limit) if len(raw_line) > limit else [raw_line]:
+            in_code = open_fence is not None
+            markdown_line = line if in_code or toggles else escape_line(line)
+            if len(markdown_line) > limit:
+                # Escaping can only double a line; fall back to the plain text for this one
+                markdown_line = line
+
+            reserve = fence_reserve if in_code or toggles else 0
+            if length + len(markdown_line) + 1 + reserve > max_length:
+                if paragraph_break and not in_code and paragraph_break * 2 > len(markdown_lines):
+                    flush(paragraph_break)
+                if length + len(markdown_line) + 1 + reserve > max_length:
+                    flush(len(markdown_lines))
+
+            markdown_lines.append(markdown_line)
+            plain_lines.append(line)
+            length += len(markdown_line) + 1
+            if opener is not None:
+                # The rest of a split opening line is already inside the block
+                open_fence = opener
+
+        if toggles and opener is None:
+            open_fence = None
+        elif open_fence is None and not raw_line.strip():
+            paragraph_break = len(markdown_lines)
+
+    flush(len(markdown_lines))
+    return chunks
+
@@ -0,0 +1,119 @@
+# bot_app/fastpath.py
+
+import logging
+
+from django.urls import reverse
+
+from . import views
+from .updates import loads, secret_matches
+
+MAX_UPDATE_SIZE = 1024 * 1024  # Telegram updates are a few KB at most
+SECRET_HEADER = b"x-telegram-bot-api-secret-token"
+
+
+async def _respond(send, status):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/plain"), (b"content-length", b"0")],
+    })
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def _read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return b""
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_UPDATE_SIZE:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def handle_update(scope, receive, send):
+    """Answer a Telegram webhook POST without going through Django's request cycle."""
+    secret = None
+    for name, value in scope["headers"]:
+        if name == SECRET_HEADER:
+            secret = value
+            break
+
+    # Junk traffic is turned away before a single byte of the body is read
+    if not secret_matches(views.TELEGRAM_WEBHOOK_SECRET, secret):
+        await _respond(send, 403)
+        return
+
+    # While shutting down, let Telegram redeliver the update to the next instance
+    if not views.lifecycle.accepting:
+        await _respond(send, 503)
+        return
+
+    body = await _read_body(receive)
+    if body is None:
+        await _respond(send, 413)
+        return
+
+    try:
+        data = loads(body)
+    except ValueError as e:
+        logging.error(f"Failed to parse JSON: {e}")
+        await _respond(send, 400)
+        return
+
+    if not isinstance(data, dict):
+        await _respond(send, 400)
+        return
+
+    try:
+        await views.dispatch_update(data)
+    except Exception as e:
+        # Not acknowledged, so Telegram delivers the update again
+        logging.error(f"Failed to dispatch update {data.get('update_id')}: {e}")
+        await _respond(send, 500)
+        return
+    await _respond(send, 200)
+
+
+async def handle_lifespan(receive, send):
+    """Start the bot with the server and drain it on SIGTERM, via the ASGI lifespan protocol."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                # Initializing early also resumes checkpoints left by the previous instance
+                await views.ensure_application_initialized()
+            except Exception as e:
+                # Not fatal: the first update tries again
+                logging.error(f"Failed to initialize the application on startup: {e}")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            try:
+                await views.shutdown()
+            except Exception as e:
+                logging.error(f"Failed to shut down cleanly: {e}")
+                await send({"type": "lifespan.shutdown.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def webhook_fast_path(django_application):
+    """Wrap the Django ASGI application so webhook POSTs skip middleware, sessions and URL routing."""
+    webhook_path = reverse("webhook")
+
+    async def application(scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == webhook_path:
+            await handle_update(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            # Django itself does not speak the lifespan protocol
+            await handle_lifespan(receive, send)
+        else:
+            await django_application(scope, receive, send)
+
+    return application
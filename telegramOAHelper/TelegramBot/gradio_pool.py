@@ -0,0 +1,107 @@
+# bot_app/gradio_pool.py
+
+import asyncio
+import logging
+from collections import defaultdict
+
+from gradio_client import Client
+
+
+class JobSuperseded(Exception):
+    """Raised for a job that was cancelled because its owner submitted a newer one."""
+
+
+class GradioPool:
+    """Warm gradio_client connections per Space, with non-blocking job submission.
+
+    Creating a Client fetches the Space config over the network, so idle
+    clients are kept around and reused. Jobs go through ``Client.submit`` and
+    are awaited as futures instead of blocking a thread in ``predict``, which
+    also lets us read the Space's queue position while waiting.
+    """
+
+    def __init__(self, max_idle_per_space=4, poll_interval=1.0):
+        self.max_idle_per_space = max_idle_per_space
+        self.poll_interval = poll_interval
+        self._idle = defaultdict(list)  # space -> [Client]
+        self._active = {}  # owner -> running Job
+        # Job.cancel() only flags queued jobs on the Space and never cancels the
+        # job's future, so superseded jobs are remembered here instead
+        self._superseded = set()
+
+    async def _checkout(self, space):
+        if self._idle[space]:
+            return self._idle[space].pop()
+        logging.info(f"Opening a new Gradio client for {space}")
+        return await asyncio.to_thread(Client, space, verbose=False)
+
+    def _checkin(self, space, client):
+        if len(self._idle[space]) < self.max_idle_per_space:
+            self._idle[space].append(client)
+
+    async def warm(self, space, count=1):
+        """Open ``count`` clients for ``space`` ahead of the first request."""
+        clients = await asyncio.gather(*(self._checkout(space) for _ in range(count)))
+        for client in clients:
+            self._checkin(space, client)
+
+    async def submit(self, space, owner=None, on_status=None, **kwargs):
+        """Run a job on ``space`` and return its result.
+
+        A newer job from the same ``owner`` supersedes this one, which then
+        raises JobSuperseded. Owners should identify both the user and what
+        they sent, so unrelated requests never cancel each other. ``on_status`` is
+        awaited with the job's gradio StatusUpdate while it waits in the queue.
+        """
+        client = await self._checkout(space)
+        job = client.submit(**kwargs)
+
+        if owner is not None:
+            stale = self._active.get(owner)
+            if stale is not None and not stale.done():
+                logging.info(f"Cancelling superseded Gradio job for {owner}")
+                self._superseded.add(stale)
+                stale.cancel()
+            self._active[owner] = job
+
+        future = asyncio.wrap_future(job)
+        superseded = False
+        try:
+            while job not in self._superseded:
+                done, _ = await asyncio.wait({future}, timeout=self.poll_interval)
+                if done:
+                    break
+                if on_status is not None:
+                    try:
+                        await on_status(job.status())
+                    except Exception as e:
+                        logging.error(f"Error reporting Gradio job status: {e}")
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+        finally:
+            if owner is not None and self._active.get(owner) is job:
+                del self._active[owner]
+            if job in self._superseded:
+                self._superseded.discard(job)
+                superseded = True
+            self._checkin(space, client)
+
+        if superseded:
+            # Whatever the worker thread still produces is of no interest
+            future.add_done_callback(lambda done: done.cancelled() or done.exception())
+            raise JobSuperseded(f"Job on {space} was superseded by a newer request")
+        return future.result()
+
+
+# Helper function to describe where a job stands in the Space's queue
+def describe_status(status):
+    rank = getattr(status, "rank", None)
+    if rank is None:
+        return None
+    text = f"Waiting in the model queue: position {rank + 1}"
+    if getattr(status, "queue_size", None):
+        text += f" of {status.queue_size}"
+    if getattr(status, "eta", None):
+        text += f", about {status.eta:.0f}s left"
+    return text
@@ -0,0 +1,121 @@
+# bot_app/helpers.py
+
+import asyncio
+import logging
+import os
+import tempfile
+
+import google.generativeai as genai
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest
+from telegram.ext import ContextTypes
+
+from .chunker import chunk_markdown
+
+# The models a chat can choose between; each entry point maps them to its own backend's model names
+MODEL_CHOICES = ("o1", "o1mini", "ChatGPT4")
+ALBUM_QUIET_PERIOD = 2  # seconds without a new photo before an album is processed
+
+
+class ModelChoice(asyncio.Event):
+    """Set once a chat chooses a model; counts the pipelines still waiting for it."""
+
+    def __init__(self):
+        super().__init__()
+        self.waiters = 0
+
+
+# Helper function to build the model selection keyboard
+def model_keyboard():
+    keyboard = [[InlineKeyboardButton(f"Use {choice}", callback_data=choice)] for choice in MODEL_CHOICES]
+    return InlineKeyboardMarkup(keyboard)
+
+
+# Start command handler
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "Choose the model you want to use to process the image analysis output:",
+        reply_markup=model_keyboard(),
+    )
+
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    selected_model = query.data
+    context.chat_data["selected_model"] = selected_model  # Use chat_data instead
+
+    if selected_model in MODEL_CHOICES:
+        # Release any images that were read while the choice was pending
+        model_selected = context.chat_data.pop("model_selected", None)
+        if model_selected is not None:
+            model_selected.set()
+            await query.edit_message_text(f"You selected {selected_model}. Answering your questions now.")
+            return
+
+        await query.edit_message_text(
+            f"You selected {selected_model}. Please upload an image for analysis."
+        )
+    else:
+        await query.edit_message_text("Model selection failed!")
+
+
+# Add a media group photo to the buffer and (re)schedule ``callback`` for when the album goes quiet
+def buffer_album_photo(context, album_buffer, callback, photo, chat_id, user_id, media_group_id):
+    album_key = (chat_id, media_group_id)
+    album = album_buffer.add(album_key, chat_id, user_id, photo)
+
+    if album.job is not None:
+        album.job.schedule_removal()
+
+    album.job = context.application.job_queue.run_once(
+        callback,
+        when=ALBUM_QUIET_PERIOD,
+        data=album_key,
+        user_id=user_id,
+        chat_id=chat_id,
+    )
+
+
+# Send a long Markdown text in boundary-aware chunks. A chunk Telegram still
+# cannot parse is re-sent as plain text so the answer is never lost.
+async def send_markdown(bot, chat_id, text, max_length, header="", footer=""):
+    for markdown, plain in chunk_markdown(text, max_length - len(header) - len(footer)):
+        try:
+            await bot.send_message(chat_id=chat_id, text=header + markdown + footer, parse_mode="Markdown")
+        except BadRequest as e:
+            if "parse" not in str(e).lower():
+                raise
+            logging.warning(f"Telegram rejected a Markdown chunk, sending it as plain text: {e}")
+            await bot.send_message(chat_id=chat_id, text=header + plain + footer)
+
+
+# Helper function to upload image to GenAI
+async def upload_image_to_genai(file):
+    # Create a temporary file
+    fd, temp_file_path = tempfile.mkstemp(suffix=".jpg")
+    os.close(fd)  # Close the file descriptor
+
+    try:
+        # Download the file from Telegram to the temporary file
+        await file.download_to_drive(temp_file_path)
+
+        # Upload the file to GenAI without blocking the event loop
+        sample_file = await asyncio.to_thread(
+            genai.upload_file, path=temp_file_path, display_name="Uploaded Image"
+        )
+        logging.info(
+            f"Uploaded file '{sample_file.display_name}' as: {sample_file.uri}"
+        )
+        return sample_file
+    finally:
+        # Clean up: remove the temporary file
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+
+
+# Download one photo and upload it to GenAI
+async def upload_photo(bot, file_id):
+    file = await bot.get_file(file_id)
+    return await upload_image_to_genai(file)
@@ -0,0 +1,85 @@
+# bot_app/lifecycle.py
+
+import asyncio
+import logging
+from contextlib import contextmanager
+
+
+class PendingRun:
+    """One set of photos on its way through the pipeline, and how far it got."""
+    __slots__ = ("chat_id", "user_id", "photos", "model", "delivered", "task")
+
+    def __init__(self, chat_id, user_id, photos, model=None, delivered=()):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.photos = list(photos)
+        self.model = model
+        self.delivered = list(delivered)  # question numbers already sent to the chat
+        self.task = None
+
+
+class Lifecycle:
+    """Tracks the work in flight so a shutdown can wait for it or hand it over.
+
+    Update tasks are started with ``spawn`` and pipeline runs register
+    themselves with ``running``. ``drain`` stops new work from being
+    accepted, waits for what is already running up to a deadline and
+    returns the runs that did not make it, so they can be checkpointed
+    and resumed by the next instance.
+    """
+
+    def __init__(self):
+        self.accepting = True
+        self._tasks = set()
+        self._runs = set()
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    @contextmanager
+    def running(self, run):
+        run.task = asyncio.current_task()
+        self._runs.add(run)
+        try:
+            yield run
+        finally:
+            self._runs.discard(run)
+
+    def _live(self):
+        # Media group runs are started by the job queue, not by spawn
+        tasks = self._tasks | {run.task for run in self._runs if run.task is not None}
+        return {task for task in tasks if not task.done()}
+
+    async def drain(self, deadline, grace=5):
+        """Wait up to ``deadline`` seconds for in-flight work, then cancel what is left.
+
+        Returns the runs whose tasks were cancelled and awaited; runs that
+        finished on their own are never returned, so nothing is done twice.
+        """
+        self.accepting = False
+        loop = asyncio.get_running_loop()
+        end = loop.time() + deadline
+
+        # Running tasks may start others (resumed checkpoints), so wait until none are left
+        tasks = self._live()
+        if tasks:
+            logging.info(f"Draining {len(tasks)} task(s), {len(self._runs)} pipeline run(s)")
+        while tasks and loop.time() < end:
+            await asyncio.wait(tasks, timeout=end - loop.time())
+            tasks = self._live()
+        if not tasks:
+            return []
+
+        unfinished = [run for run in self._runs if run.task in tasks]
+        for task in tasks:
+            task.cancel()
+        # Give cancelled runs a moment to tell their chats
+        await asyncio.wait(tasks, timeout=grace)
+        logging.warning(f"Cancelled {len(tasks)} task(s) still running after {deadline}s")
+        return unfinished
+
+    def __len__(self):
+        return len(self._tasks)
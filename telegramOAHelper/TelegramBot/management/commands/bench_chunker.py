@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from TelegramBot.chunker import chunk_markdown
+
+# A code-heavy answer with the Markdown the models usually produce
+PARAGRAPH = (
+    "Use a **min-heap** to keep the k_smallest items [see notes] and `pop` them:\n\n"
+    "```cpp\n" + "\n".join(f"    heap.push(values[{i}]); // step {i}" for i in range(40)) + "\n```\n\n"
+)
+
+
+class Command(BaseCommand):
+    help = "Measure how fast chunk_markdown splits a large, code-heavy answer."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--paragraphs", type=int, default=2000)
+        parser.add_argument("--max-length", type=int, default=4000)
+
+    def handle(self, *args, **options):
+        text = PARAGRAPH * options["paragraphs"]
+        start = time.perf_counter()
+        chunks = chunk_markdown(text, options["max_length"])
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            f"{len(text) / 1e6:.1f} MB into {len(chunks)} chunks in {elapsed * 1000:.0f} ms "
+            f"({len(text) / 1e6 / elapsed:.1f} MB/s)"
+        )
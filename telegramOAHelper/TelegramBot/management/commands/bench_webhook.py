@@ -0,0 +1,89 @@
+import asyncio
+import json
+import time
+
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient
+from django.urls import reverse
+
+from TelegramBot import views
+from TelegramBot.fastpath import webhook_fast_path
+
+SECRET = "bench-secret"
+
+
+def sample_update(update_id):
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1700000000,
+            "chat": {"id": 123456, "type": "private", "first_name": "Bench"},
+            "from": {"id": 123456, "is_bot": False, "first_name": "Bench"},
+            "text": "hello",
+        },
+    }).encode()
+
+
+class Command(BaseCommand):
+    help = "Measure the per-update overhead of the Django webhook view and the ASGI fast path."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--updates", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        asyncio.run(self.bench(options["updates"]))
+
+    async def bench(self, count):
+        # Keep everything in-process: no Telegram calls, no handlers run
+        async def process_update(update):
+            pass
+
+        original = (views.application.process_update, views.application_initialized, views.TELEGRAM_WEBHOOK_SECRET)
+        views.application.process_update = process_update
+        views.application_initialized = True
+        views.TELEGRAM_WEBHOOK_SECRET = SECRET
+        try:
+            path = reverse("webhook")
+            client = AsyncClient()
+            start = time.perf_counter()
+            for i in range(count):
+                await client.post(
+                    path, data=sample_update(i), content_type="application/json",
+                    headers={"X-Telegram-Bot-Api-Secret-Token": SECRET},
+                )
+            django_time = (time.perf_counter() - start) / count
+
+            app = webhook_fast_path(get_asgi_application())
+            fast_time = await self.bench_asgi(app, path, count, offset=count, secret=SECRET.encode())
+            junk_time = await self.bench_asgi(app, path, count, offset=2 * count, secret=b"wrong")
+        finally:
+            views.application.process_update, views.application_initialized, views.TELEGRAM_WEBHOOK_SECRET = original
+
+        self.stdout.write(f"Django view:          {django_time * 1e6:8.1f} us/update")
+        self.stdout.write(f"ASGI fast path:       {fast_time * 1e6:8.1f} us/update")
+        self.stdout.write(f"Rejected (bad token): {junk_time * 1e6:8.1f} us/update")
+
+    async def bench_asgi(self, app, path, count, offset, secret):
+        async def send(message):
+            pass
+
+        start = time.perf_counter()
+        for i in range(count):
+            body = sample_update(offset + i)
+
+            async def receive(body=body):
+                return {"type": "http.request", "body": body, "more_body": False}
+
+            scope = {
+                "type": "http",
+                "method": "POST",
+                "path": path,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"x-telegram-bot-api-secret-token", secret),
+                ],
+            }
+            await app(scope, receive, send)
+        return (time.perf_counter() - start) / count
@@ -0,0 +1,41 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Extraction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image_hash', models.CharField(db_index=True, max_length=64)),
+                ('chat_id', models.BigIntegerField(db_index=True)),
+                ('questions', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Answer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.BigIntegerField(db_index=True)),
+                ('question_number', models.CharField(max_length=16)),
+                ('question_hash', models.CharField(max_length=64)),
+                ('question_text', models.TextField()),
+                ('model', models.CharField(max_length=32)),
+                ('answer_text', models.TextField()),
+                ('delivered', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('extraction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='answers', to='TelegramBot.extraction')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['question_hash', 'model'], name='answer_question_model_idx'), models.Index(fields=['chat_id', 'delivered'], name='answer_chat_delivered_idx')],
+            },
+        ),
+    ]
@@ -1,3 +1,49 @@
 from django.db import models
 
-# Create your models here.
+
+# Questions extracted from one photo or album, so a re-sent image needs no OCR
+class Extraction(models.Model):
+    image_hash = models.CharField(max_length=64, db_index=True)
+    chat_id = models.BigIntegerField(db_index=True)
+    questions = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.image_hash[:12]} ({len(self.questions)} question(s))"
+
+
+# A model's answer to one extracted question
+class Answer(models.Model):
+    extraction = models.ForeignKey(
+        Extraction, null=True, blank=True, on_delete=models.CASCADE, related_name="answers"
+    )
+    chat_id = models.BigIntegerField(db_index=True)
+    question_number = models.CharField(max_length=16)
+    question_hash = models.CharField(max_length=64)
+    question_text = models.TextField()
+    model = models.CharField(max_length=32)
+    answer_text = models.TextField()
+    delivered = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["question_hash", "model"], name="answer_question_model_idx"),
+            models.Index(fields=["chat_id", "delivered"], name="answer_chat_delivered_idx"),
+        ]
+
+    def __str__(self):
+        return f"Question {self.question_number} ({self.model})"
+
+
+# Photos whose processing was interrupted by a shutdown, resumed by the next instance
+class Checkpoint(models.Model):
+    chat_id = models.BigIntegerField()
+    user_id = models.BigIntegerField(null=True, blank=True)
+    photos = models.JSONField()
+    model = models.CharField(max_length=32, blank=True)
+    delivered = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Chat {self.chat_id} ({len(self.photos)} photo(s))"
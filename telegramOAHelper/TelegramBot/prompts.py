@@ -0,0 +1,116 @@
+# bot_app/prompts.py
+
+import inspect
+import logging
+import re
+
+from .tokens import estimate_tokens
+
+
+# Helper function to strip the indentation and padding that the templates pick up in source
+def compact(text):
+    text = inspect.cleandoc(text)
+    text = "\n".join(line.rstrip() for line in text.splitlines())
+    return re.sub(r"\n{3,}", "\n\n", text)
+
+
+class PromptTemplate:
+    """A versioned prompt with a fixed system part and a small per-request user part.
+
+    The system message never changes between requests and is always sent
+    first, byte-for-byte identical. Note that OpenAI only caches prompts of
+    1024 tokens or more; the answer prompts here are around 200 tokens, so
+    their savings come from compaction alone and ``cached_tokens`` stays at
+    zero until a template grows past that threshold.
+    """
+
+    def __init__(self, name, version, system, user):
+        self.name = name
+        self.version = version
+        self.system = compact(system) if system else ""
+        self.user = compact(user)
+
+        # Token accounting
+        self.calls = 0
+        self.estimated_tokens = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def build(self, **fields):
+        messages = []
+        if self.system:
+            messages.append({"role": "system", "content": self.system})
+        messages.append({"role": "user", "content": self.user.format(**fields)})
+        return messages
+
+    def estimate(self, messages):
+        return sum(estimate_tokens(message["content"]) for message in messages)
+
+    def record(self, messages, usage):
+        """Account one request made with this template against the backend's reported ``Usage``."""
+        self.calls += 1
+        self.estimated_tokens += self.estimate(messages)
+        if usage is None:
+            return
+        self.prompt_tokens += usage.prompt_tokens
+        self.cached_tokens += usage.cached_tokens
+        logging.debug(f"Prompt template {self.name} v{self.version}: {self.stats()}")
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "estimated_tokens": self.estimated_tokens,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cache_hit_ratio": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+        }
+
+
+TEMPLATES = {}
+
+
+def register(template):
+    TEMPLATES.setdefault(template.name, {})[template.version] = template
+    return template
+
+
+def get_template(name, version=None):
+    """Return the requested version of a template, or the latest one."""
+    versions = TEMPLATES[name]
+    if version is None:
+        return versions[max(versions)]
+    return versions[int(version)]
+
+
+# Version 1 is the original single-message layout, kept for comparison
+register(PromptTemplate(
+    "answer", 1,
+    system=None,
+    user='''Deliver your answer clearly and concisely:
+
+        1. **For multiple-choice questions (MCQs)**, only provide the correct option number and option value, also Encapsulate the option using triple backticks (```) to enhance readability (e.g., "```Answer: B <option value>```") without any additional explanation unless specified.
+
+        2. **For questions involving code**, use C++ and format your code clearly. Encapsulate code segments using triple backticks (```) to enhance readability.
+
+        3. **For non-code questions** that require explanations, provide a straightforward answer give code block only if needed.
+
+        Answer the question in a format that is precise, directly addresses the specifics, and is easy to read in a Telegram message.
+
+        Question {question_number}: {question_text}''',
+))
+
+# Version 2 splits the fixed instructions into a system message; the template
+# is compacted, but too short to qualify for OpenAI's prompt cache
+register(PromptTemplate(
+    "answer", 2,
+    system='''Deliver your answer clearly and concisely:
+
+        1. **For multiple-choice questions (MCQs)**, only provide the correct option number and option value, also Encapsulate the option using triple backticks (```) to enhance readability (e.g., "```Answer: B <option value>```") without any additional explanation unless specified.
+
+        2. **For questions involving code**, use C++ and format your code clearly. Encapsulate code segments using triple backticks (```) to enhance readability.
+
+        3. **For non-code questions** that require explanations, provide a straightforward answer give code block only if needed.
+
+        Answer the question in a format that is precise, directly addresses the specifics, and is easy to read in a Telegram message.''',
+    user='''Question {question_number}: {question_text}''',
+))
@@ -0,0 +1,128 @@
+# bot_app/ratelimit.py
+
+import asyncio
+import hashlib
+import logging
+import random
+import sqlite3
+import time
+from contextlib import closing
+
+WINDOW = 60  # seconds; providers enforce per-minute limits
+
+
+class RateBudget:
+    """Requests-per-minute and tokens-per-minute budget shared by every worker.
+
+    Usage is recorded in a small SQLite database so that all processes serving
+    the bot pace themselves against the same sliding window instead of each
+    one discovering the limit through 429 responses.
+    """
+
+    def __init__(self, db_path, limits):
+        # limits: {provider: (api_key, rpm, tpm)}
+        self.db_path = str(db_path)
+        self.buckets = {}
+        for provider, (api_key, rpm, tpm) in limits.items():
+            key_hash = hashlib.sha256((api_key or "").encode()).hexdigest()[:8]
+            self.buckets[provider] = (f"{provider}:{key_hash}", rpm, tpm)
+
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_usage ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, bucket TEXT NOT NULL, ts REAL NOT NULL, tokens INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS rate_usage_bucket_ts ON rate_usage (bucket, ts)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_backoff (bucket TEXT PRIMARY KEY, until REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    # Reserve one request and `tokens` tokens, or report how long to wait
+    def _try_reserve(self, bucket, rpm, tpm, tokens):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM rate_usage WHERE bucket = ? AND ts <= ?", (bucket, now - WINDOW))
+
+            row = conn.execute("SELECT until FROM rate_backoff WHERE bucket = ?", (bucket,)).fetchone()
+            if row and row[0] > now:
+                conn.execute("COMMIT")
+                return None, row[0] - now
+
+            rows = conn.execute(
+                "SELECT ts, tokens FROM rate_usage WHERE bucket = ? ORDER BY ts", (bucket,)
+            ).fetchall()
+            used_tokens = sum(t for _, t in rows)
+
+            # A request larger than the whole budget still goes through on an idle window
+            fits_tokens = used_tokens + tokens <= tpm or not rows
+            if len(rows) < rpm and fits_tokens:
+                cursor = conn.execute(
+                    "INSERT INTO rate_usage (bucket, ts, tokens) VALUES (?, ?, ?)", (bucket, now, tokens)
+                )
+                conn.execute("COMMIT")
+                return cursor.lastrowid, 0.0
+            conn.execute("COMMIT")
+        except Exception:
+            # Nothing to undo if BEGIN itself timed out; let that error through
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        # Work out when enough of the window expires for this request to fit
+        wait = 0.0
+        if len(rows) >= rpm:
+            wait = rows[len(rows) - rpm][0] + WINDOW - now
+        if not fits_tokens:
+            freed = 0
+            for ts, t in rows:
+                freed += t
+                if used_tokens - freed + tokens <= tpm:
+                    wait = max(wait, ts + WINDOW - now)
+                    break
+        return None, max(wait, 0.05)
+
+    async def acquire(self, provider, tokens):
+        """Wait until `provider` has room for one request of `tokens` tokens; returns a reservation id."""
+        bucket, rpm, tpm = self.buckets[provider]
+        waited = 0.0
+        while True:
+            reservation, wait = await asyncio.to_thread(self._try_reserve, bucket, rpm, tpm, tokens)
+            if reservation is not None:
+                if waited:
+                    logging.info(f"Paced {provider} request for {waited:.1f}s to stay under its rate limit")
+                return reservation
+            # Jitter keeps workers that wake up together from racing for the same slot
+            wait = min(wait, WINDOW) + random.uniform(0, 0.25)
+            waited += wait
+            await asyncio.sleep(wait)
+
+    def _settle(self, reservation, tokens):
+        with closing(self._connect()) as conn:
+            conn.execute("UPDATE rate_usage SET tokens = ? WHERE id = ?", (tokens, reservation))
+
+    async def settle(self, reservation, tokens):
+        """Replace the estimate held by `reservation` with the real token count."""
+        if tokens is not None:
+            await asyncio.to_thread(self._settle, reservation, tokens)
+
+    def _backoff(self, bucket, until):
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO rate_backoff (bucket, until) VALUES (?, ?) "
+                "ON CONFLICT (bucket) DO UPDATE SET until = MAX(until, excluded.until)",
+                (bucket, until),
+            )
+
+    async def backoff(self, provider, seconds):
+        """Stop every worker from dispatching to `provider` for `seconds` after a 429."""
+        bucket = self.buckets[provider][0]
+        logging.warning(f"{provider} rate limit hit, pausing dispatch for {seconds:.0f}s")
+        await asyncio.to_thread(self._backoff, bucket, time.time() + seconds)
@@ -0,0 +1,189 @@
+# bot_app/scheduler.py
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+class AdmissionError(Exception):
+    """Raised when a request is refused before it is queued."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("key", "cost", "tag", "seq", "future")
+
+    def __init__(self, key, cost, tag, seq, future):
+        self.key = key
+        self.cost = cost
+        self.tag = tag
+        self.seq = seq
+        self.future = future
+
+    def __lt__(self, other):
+        return (self.tag, self.seq) < (other.tag, other.seq)
+
+
+class FairScheduler:
+    """Weighted fair queue in front of the expensive model calls.
+
+    Every waiter gets a virtual finish tag of ``max(virtual_time, last_tag[key])
+    + cost / weight``, and free slots go to the smallest tag whose key is below
+    its own concurrency cap. A user who floods the bot only pushes their own
+    tags further out, so light users keep jumping ahead of the backlog.
+    """
+
+    def __init__(self, max_concurrent=4, per_key_concurrency=1, per_key_max_pending=20,
+                 token_budget=200_000, budget_window=3600):
+        self.max_concurrent = max_concurrent
+        self.per_key_concurrency = per_key_concurrency
+        self.per_key_max_pending = per_key_max_pending
+        self.token_budget = token_budget
+        self.budget_window = budget_window
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._last_tag = defaultdict(float)
+        self._weights = {}
+        self._running = 0
+        self._running_by_key = defaultdict(int)
+        self._active_by_key = defaultdict(int)
+        self._usage = defaultdict(deque)  # key -> deque of (timestamp, tokens)
+        self._moved = None  # resolved whenever the queue changes, so waiters can re-report their position
+
+    def set_weight(self, key, weight):
+        self._weights[key] = weight
+
+    def _budget_used(self, key, now):
+        usage = self._usage[key]
+        while usage and usage[0][0] <= now - self.budget_window:
+            usage.popleft()
+        if not usage:
+            del self._usage[key]
+            return 0
+        return sum(tokens for _, tokens in usage)
+
+    # Admission control: refuse work up front instead of queueing it forever
+    @contextmanager
+    def admission(self, key, cost):
+        now = time.monotonic()
+        if self._active_by_key[key] >= self.per_key_max_pending:
+            raise AdmissionError(
+                "You already have too many requests waiting. "
+                "Please wait for them to finish before sending more."
+            )
+
+        used = self._budget_used(key, now)
+        if used + cost > self.token_budget:
+            usage = self._usage[key]
+            retry_after = usage[0][0] + self.budget_window - now if usage else self.budget_window
+            raise AdmissionError(
+                f"You have reached your usage limit. Please try again in "
+                f"{int(retry_after // 60) + 1} minute(s).",
+                retry_after=retry_after,
+            )
+
+        self._usage[key].append((now, cost))
+        self._active_by_key[key] += 1
+        try:
+            yield
+        finally:
+            self._active_by_key[key] -= 1
+            if not self._active_by_key[key]:
+                del self._active_by_key[key]
+                # Tags behind the virtual clock no longer affect ordering
+                if self._last_tag.get(key, 0.0) <= self._virtual_time:
+                    self._last_tag.pop(key, None)
+
+    # Replace the estimate charged at admission with the real token count
+    def record_usage(self, key, estimated, actual):
+        if actual is None or actual == estimated:
+            return
+        self._usage[key].append((time.monotonic(), actual - estimated))
+
+    def position(self, key):
+        """Number of waiters that will be served before the next one from ``key``."""
+        own = [w for w in self._heap if w.key == key and not w.future.done()]
+        if not own:
+            return 0
+        first = min(own)
+        return sum(1 for w in self._heap if w < first and not w.future.done()) + 1
+
+    def queued(self):
+        return sum(1 for w in self._heap if not w.future.done())
+
+    def _dispatch(self):
+        skipped = []
+        while self._heap and self._running < self.max_concurrent:
+            waiter = heapq.heappop(self._heap)
+            if waiter.future.done():
+                continue
+            if self._running_by_key.get(waiter.key, 0) >= self.per_key_concurrency:
+                skipped.append(waiter)
+                continue
+            self._virtual_time = max(self._virtual_time, waiter.tag - waiter.cost / self._weights.get(waiter.key, 1.0))
+            self._running += 1
+            self._running_by_key[waiter.key] += 1
+            waiter.future.set_result(None)
+        for waiter in skipped:
+            heapq.heappush(self._heap, waiter)
+        if self._moved is not None:
+            self._moved.set_result(None)
+            self._moved = None
+
+    def _release(self, key):
+        self._running -= 1
+        self._running_by_key[key] -= 1
+        if not self._running_by_key[key]:
+            del self._running_by_key[key]
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, key, cost, on_queued=None):
+        """Wait for a fair-share slot for ``key``.
+
+        While it has to wait, ``on_queued(position)`` is awaited whenever its
+        position in the queue changes.
+        """
+        weight = self._weights.get(key, 1.0)
+        tag = max(self._virtual_time, self._last_tag[key]) + cost / weight
+        self._last_tag[key] = tag
+
+        waiter = _Waiter(key, cost, tag, next(self._seq), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, waiter)
+        self._dispatch()
+        try:
+            reported = None
+            while not waiter.future.done():
+                position = self.position(key)
+                if on_queued is not None and position != reported:
+                    reported = position
+                    try:
+                        await on_queued(position)
+                    except Exception as e:
+                        logging.error(f"Error reporting queue position: {e}")
+                    continue
+                if self._moved is None:
+                    self._moved = asyncio.get_running_loop().create_future()
+                await asyncio.wait({waiter.future, self._moved}, return_when=asyncio.FIRST_COMPLETED)
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # We were granted a slot right as we got cancelled
+                self._release(key)
+            else:
+                waiter.future.cancel()
+            raise
+
+        try:
+            yield
+        finally:
+            self._release(key)
@@ -0,0 +1,48 @@
+# bot_app/singleflight.py
+
+import asyncio
+import logging
+import re
+
+
+# Helper function to make trivially different copies of a question share a key
+def normalize_question(text):
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into a single execution.
+
+    The first caller for a key starts the work as its own task; everyone who
+    asks for the same key while it is running awaits that task instead of
+    starting another one. Callers are shielded from each other, so one chat
+    giving up does not cancel the work for the rest. Keys are tuples whose
+    first item names the kind of work.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Make sure an error nobody is waiting for any more still counts as retrieved
+        if not task.cancelled() and task.exception() is not None:
+            logging.debug(f"In-flight call {key!r} failed: {task.exception()}")
+
+    async def do(self, key, func, *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.started += 1
+        else:
+            self.coalesced += 1
+            logging.info(f"Joining in-flight call for {key[0]}")
+        return await asyncio.shield(task)
+
+    def __len__(self):
+        return len(self._calls)
@@ -0,0 +1,131 @@
+# bot_app/store.py
+
+import hashlib
+import logging
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .albums import AlbumPhoto
+from .lifecycle import PendingRun
+from .models import Answer, Checkpoint, Extraction
+from .singleflight import normalize_question
+
+
+# Helper function to identify a photo or album independently of the chat it was sent to
+def hash_images(photos):
+    key = "|".join(photo.file_unique_id for photo in photos)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def hash_question(question_text):
+    return hashlib.sha256(normalize_question(question_text).encode()).hexdigest()
+
+
+# The extraction already made from these images in any chat, or None
+async def find_extraction(image_hash):
+    return await Extraction.objects.filter(image_hash=image_hash).order_by("-created_at").afirst()
+
+
+async def save_extraction(image_hash, chat_id, questions):
+    return await Extraction.objects.acreate(image_hash=image_hash, chat_id=chat_id, questions=questions)
+
+
+# A stored answer to the same question from the same model, or None
+async def find_answer(question_text, model):
+    answer = await (
+        Answer.objects.filter(question_hash=hash_question(question_text), model=model)
+        .order_by("-created_at")
+        .afirst()
+    )
+    return answer.answer_text if answer else None
+
+
+# The answer this chat already got for one question of an extraction, so a replay reuses its row
+async def find_chat_answer(extraction, chat_id, question_number, model):
+    return await (
+        Answer.objects.filter(
+            extraction=extraction, chat_id=chat_id, question_number=str(question_number), model=model
+        )
+        .order_by("-created_at")
+        .afirst()
+    )
+
+
+async def save_answer(extraction, chat_id, question_number, question_text, model, answer_text):
+    return await Answer.objects.acreate(
+        extraction=extraction,
+        chat_id=chat_id,
+        question_number=str(question_number),
+        question_hash=hash_question(question_text),
+        question_text=question_text,
+        model=model,
+        answer_text=answer_text,
+    )
+
+
+async def mark_delivered(answer):
+    answer.delivered = True
+    await answer.asave(update_fields=["delivered"])
+
+
+# The model of the chat's most recent answer, or None
+async def last_model(chat_id):
+    answer = await Answer.objects.filter(chat_id=chat_id).order_by("-created_at").only("model").afirst()
+    return answer.model if answer else None
+
+
+async def recent_answers(chat_id, limit=10):
+    return [answer async for answer in Answer.objects.filter(chat_id=chat_id).order_by("-created_at")[:limit]]
+
+
+# Answers that never fully reached the chat, or else the last batch that did
+async def answers_to_resend(chat_id):
+    undelivered = [
+        answer async for answer in
+        Answer.objects.filter(chat_id=chat_id, delivered=False).order_by("created_at")
+    ]
+    if undelivered:
+        return undelivered
+
+    last = await Answer.objects.filter(chat_id=chat_id, extraction__isnull=False).order_by("-created_at").afirst()
+    if last is None:
+        return []
+    return [answer async for answer in Answer.objects.filter(extraction_id=last.extraction_id).order_by("created_at")]
+
+
+async def prune(retention_days):
+    """Delete stored extractions and answers older than ``retention_days``."""
+    cutoff = timezone.now() - timedelta(days=retention_days)
+    answers, _ = await Answer.objects.filter(created_at__lt=cutoff).adelete()
+    extractions, _ = await Extraction.objects.filter(created_at__lt=cutoff).adelete()
+    logging.info(f"Pruned {answers} answer(s) and {extractions} extraction(s) older than {retention_days} days")
+
+
+async def save_checkpoints(runs):
+    await Checkpoint.objects.abulk_create([
+        Checkpoint(
+            chat_id=run.chat_id,
+            user_id=run.user_id,
+            photos=[list(photo) for photo in run.photos],
+            model=run.model or "",
+            delivered=run.delivered,
+        )
+        for run in runs
+    ])
+
+
+# Claim the checkpoints left by a previous instance; each one is handed to a single worker
+async def take_checkpoints():
+    runs = []
+    async for checkpoint in Checkpoint.objects.order_by("created_at"):
+        deleted, _ = await Checkpoint.objects.filter(pk=checkpoint.pk).adelete()
+        if deleted:
+            runs.append(PendingRun(
+                checkpoint.chat_id,
+                checkpoint.user_id,
+                [AlbumPhoto(*photo) for photo in checkpoint.photos],
+                model=checkpoint.model or None,
+                delivered=checkpoint.delivered,
+            ))
+    return runs
@@ -1,3 +1,713 @@
-from django.test import TestCase
+import asyncio
+import concurrent.futures
+import os
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase
+
+from . import backends, store, views
+from .albums import AlbumBuffer, AlbumPhoto
+from .chunker import chunk_markdown, escape_line
+from .gradio_pool import GradioPool, JobSuperseded, describe_status
+from .lifecycle import Lifecycle, PendingRun
+from .models import Answer, Extraction
+from .ratelimit import RateBudget
+from .scheduler import AdmissionError, FairScheduler
+from .singleflight import SingleFlight, normalize_question
+from .updates import RecentUpdates, secret_matches
+
+
+class FairSchedulerTests(SimpleTestCase):
+    async def hold(self, scheduler, key, release, started=None):
+        async with scheduler.slot(key, 1):
+            if started is not None:
+                started.set()
+            await release.wait()
+
+    async def test_light_user_is_served_before_heavy_backlog(self):
+        scheduler = FairScheduler(max_concurrent=1, per_key_concurrency=1)
+        release = asyncio.Event()
+        blocker = asyncio.create_task(self.hold(scheduler, "blocker", release))
+        await asyncio.sleep(0)
+
+        order = []
+
+        async def job(key, name):
+            async with scheduler.slot(key, 10):
+                order.append(name)
+
+        tasks = [asyncio.create_task(job("heavy", f"heavy{i}")) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(job("light", "light")))
+        await asyncio.sleep(0)
+
+        release.set()
+        await asyncio.gather(blocker, *tasks)
+        self.assertEqual(order, ["heavy0", "light", "heavy1", "heavy2"])
+
+    async def test_per_key_concurrency_cap(self):
+        scheduler = FairScheduler(max_concurrent=2, per_key_concurrency=1)
+        release = asyncio.Event()
+        started = asyncio.Event()
+        first = asyncio.create_task(self.hold(scheduler, "a", release, started))
+        await started.wait()
+
+        same_key = asyncio.create_task(self.hold(scheduler, "a", release))
+        other_started = asyncio.Event()
+        other_key = asyncio.create_task(self.hold(scheduler, "b", release, other_started))
+        await asyncio.wait_for(other_started.wait(), 1)
+
+        # "b" got the second slot while "a" is capped at one
+        self.assertEqual(scheduler.queued(), 1)
+        self.assertEqual(scheduler.position("a"), 1)
+
+        release.set()
+        await asyncio.gather(first, same_key, other_key)
+        self.assertEqual(scheduler.queued(), 0)
+
+    async def test_on_queued_reports_position(self):
+        scheduler = FairScheduler(max_concurrent=1)
+        release = asyncio.Event()
+        blocker = asyncio.create_task(self.hold(scheduler, "blocker", release))
+        await asyncio.sleep(0)
+
+        positions = []
+
+        async def on_queued(position):
+            positions.append(position)
+
+        async def job():
+            async with scheduler.slot("user", 1, on_queued=on_queued):
+                pass
+
+        task = asyncio.create_task(job())
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocker, task)
+        self.assertEqual(positions, [1])
+
+    async def test_position_is_reported_again_as_the_queue_moves(self):
+        scheduler = FairScheduler(max_concurrent=1)
+        release = asyncio.Event()
+        blocker = asyncio.create_task(self.hold(scheduler, "blocker", release))
+        await asyncio.sleep(0)
+
+        releases = {key: asyncio.Event() for key in ("a", "b")}
+        ahead = [asyncio.create_task(self.hold(scheduler, key, releases[key])) for key in releases]
+        await asyncio.sleep(0)
+
+        positions = []
+
+        async def on_queued(position):
+            positions.append(position)
+
+        async def job():
+            async with scheduler.slot("c", 1, on_queued=on_queued):
+                pass
+
+        task = asyncio.create_task(job())
+        for event in (release, releases["a"], releases["b"]):
+            await asyncio.sleep(0.01)
+            event.set()
+        await asyncio.gather(blocker, *ahead, task)
+        self.assertEqual(positions, [3, 2, 1])
+
+    async def test_cancelled_waiter_frees_its_place(self):
+        scheduler = FairScheduler(max_concurrent=1)
+        release = asyncio.Event()
+        blocker = asyncio.create_task(self.hold(scheduler, "blocker", release))
+        await asyncio.sleep(0)
+
+        waiter = asyncio.create_task(self.hold(scheduler, "user", asyncio.Event()))
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.queued(), 1)
+
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertEqual(scheduler.queued(), 0)
+
+        release.set()
+        await blocker
+
+        # The cancelled waiter must not have kept the only slot
+        async with scheduler.slot("user", 1):
+            pass
+        self.assertEqual(scheduler.queued(), 0)
+
+    def test_admission_refuses_too_many_pending(self):
+        scheduler = FairScheduler(per_key_max_pending=1)
+        with scheduler.admission("user", 1):
+            with self.assertRaises(AdmissionError):
+                with scheduler.admission("user", 1):
+                    pass
+            # Other users are not affected
+            with scheduler.admission("other", 1):
+                pass
+        with scheduler.admission("user", 1):
+            pass
+
+    def test_admission_refuses_over_budget(self):
+        scheduler = FairScheduler(token_budget=100, budget_window=3600)
+        with scheduler.admission("user", 60):
+            pass
+        with self.assertRaises(AdmissionError) as refused:
+            with scheduler.admission("user", 60):
+                pass
+        self.assertGreater(refused.exception.retry_after, 0)
+
+    def test_record_usage_corrects_the_estimate(self):
+        scheduler = FairScheduler(token_budget=100, budget_window=3600)
+        with scheduler.admission("user", 60):
+            pass
+        scheduler.record_usage("user", 60, 10)
+        with scheduler.admission("user", 60):
+            pass
+
+
+class SingleFlightTests(SimpleTestCase):
+    async def test_concurrent_calls_share_one_execution(self):
+        inflight = SingleFlight()
+        calls = []
+        release = asyncio.Event()
+
+        async def work(value):
+            calls.append(value)
+            await release.wait()
+            return value * 2
+
+        tasks = [asyncio.create_task(inflight.do(("work", 1), work, 21)) for _ in range(3)]
+        await asyncio.sleep(0)
+        self.assertEqual(len(inflight), 1)
+
+        release.set()
+        self.assertEqual(await asyncio.gather(*tasks), [42, 42, 42])
+        self.assertEqual(calls, [21])
+        self.assertEqual((inflight.started, inflight.coalesced), (1, 2))
+        self.assertEqual(len(inflight), 0)
+
+    async def test_finished_key_runs_again(self):
+        inflight = SingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(None)
+            return len(calls)
+
+        self.assertEqual(await inflight.do(("work",), work), 1)
+        self.assertEqual(await inflight.do(("work",), work), 2)
+
+    async def test_error_reaches_every_caller_and_is_not_cached(self):
+        inflight = SingleFlight()
+        release = asyncio.Event()
+
+        async def fail():
+            await release.wait()
+            raise ValueError("boom")
+
+        tasks = [asyncio.create_task(inflight.do(("fail",), fail)) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(len(inflight), 0)
+
+    async def test_cancelled_caller_does_not_cancel_the_others(self):
+        inflight = SingleFlight()
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return "done"
+
+        first = asyncio.create_task(inflight.do(("work",), work))
+        second = asyncio.create_task(inflight.do(("work",), work))
+        await asyncio.sleep(0)
+
+        first.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+        release.set()
+        self.assertEqual(await second, "done")
+
+    def test_normalize_question(self):
+        self.assertEqual(normalize_question("  What is\n 2 +  2? "), "what is 2 + 2?")
+
+
+class AlbumBufferTests(SimpleTestCase):
+    def photo(self, n):
+        return AlbumPhoto(f"file{n}", f"unique{n}", 1000)
+
+    def test_photos_are_grouped_and_capped(self):
+        buffer = AlbumBuffer(max_photos_per_album=2)
+        for n in range(3):
+            album = buffer.add(("chat", "group"), 1, 2, self.photo(n))
+        self.assertEqual(album.photos, [self.photo(0), self.photo(1)])
+        self.assertEqual(len(buffer), 1)
+        self.assertIs(buffer.pop(("chat", "group")), album)
+        self.assertIsNone(buffer.pop(("chat", "group")))
+
+    def test_least_recently_updated_album_is_evicted_when_full(self):
+        buffer = AlbumBuffer(max_albums=2)
+        first = buffer.add("a", 1, 1, self.photo(0))
+        first.job = mock.Mock()
+        buffer.add("b", 1, 1, self.photo(1))
+        buffer.add("a", 1, 1, self.photo(2))  # "a" is now the most recent
+        buffer.add("c", 1, 1, self.photo(3))
+
+        self.assertIsNone(buffer.pop("b"))
+        self.assertIsNotNone(buffer.pop("a"))
+        self.assertEqual(buffer.evicted, 1)
+        first.job.schedule_removal.assert_not_called()
+
+    def test_sweep_evicts_expired_albums_and_their_jobs(self):
+        buffer = AlbumBuffer(max_age=120)
+        with mock.patch("TelegramBot.albums.time.monotonic", return_value=1000):
+            old = buffer.add("old", 1, 1, self.photo(0))
+            old.job = mock.Mock()
+        with mock.patch("TelegramBot.albums.time.monotonic", return_value=1100):
+            buffer.add("new", 1, 1, self.photo(1))
+        with mock.patch("TelegramBot.albums.time.monotonic", return_value=1150):
+            buffer.sweep()
+
+        self.assertIsNone(buffer.pop("old"))
+        self.assertIsNotNone(buffer.pop("new"))
+        old.job.schedule_removal.assert_called_once_with()
+        self.assertEqual(buffer.evicted, 1)
+
+    def test_drain_hands_over_every_album(self):
+        buffer = AlbumBuffer()
+        buffer.add("a", 1, 1, self.photo(0))
+        buffer.add("b", 1, 1, self.photo(1))
+        self.assertEqual(len(buffer.drain()), 2)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(buffer.stats()["albums"], 0)
+
+
+class StoreTests(TestCase):
+    async def test_replayed_image_reuses_extraction_and_answer_rows(self):
+        photos = [AlbumPhoto("file", "unique", 1000)]
+        image_hash = store.hash_images(photos)
+        self.assertIsNone(await store.find_extraction(image_hash))
+
+        extraction = await store.save_extraction(image_hash, 1, {"1": "What is 2 + 2?"})
+        answer = await store.save_answer(extraction, 1, "1", "What is 2 + 2?", "o1", "4")
+
+        found = await store.find_extraction(image_hash)
+        self.assertEqual(found.pk, extraction.pk)
+        self.assertEqual((await store.find_chat_answer(found, 1, "1", "o1")).pk, answer.pk)
+
+        # Another chat or model gets its own row; the answer text is still shared
+        self.assertIsNone(await store.find_chat_answer(found, 2, "1", "o1"))
+        self.assertIsNone(await store.find_chat_answer(found, 1, "1", "ChatGPT4"))
+        self.assertEqual(await store.find_answer("  what is 2 +  2? ", "o1"), "4")
+
+        self.assertEqual(await Extraction.objects.acount(), 1)
+        self.assertEqual(await Answer.objects.acount(), 1)
+
+    async def test_last_model_of_the_chat(self):
+        self.assertIsNone(await store.last_model(1))
+        await store.save_answer(None, 1, "1", "a", "o1", "A")
+        await store.save_answer(None, 1, "2", "b", "ChatGPT4", "B")
+        await store.save_answer(None, 2, "1", "a", "o1mini", "A")
+        self.assertEqual(await store.last_model(1), "ChatGPT4")
+
+    async def test_answers_to_resend_prefers_undelivered(self):
+        extraction = await store.save_extraction("hash", 1, {"1": "a", "2": "b"})
+        first = await store.save_answer(extraction, 1, "1", "a", "o1", "A")
+        second = await store.save_answer(extraction, 1, "2", "b", "o1", "B")
+        await store.mark_delivered(first)
+
+        self.assertEqual([answer.pk for answer in await store.answers_to_resend(1)], [second.pk])
+        await store.mark_delivered(second)
+        self.assertEqual([answer.pk for answer in await store.answers_to_resend(1)], [first.pk, second.pk])
+
+
+class ChunkMarkdownTests(SimpleTestCase):
+    def test_short_text_is_one_chunk(self):
+        self.assertEqual(chunk_markdown("Answer: B", 100), [("Answer: B", "Answer: B")])
+
+    def test_chunks_respect_the_limit(self):
+        text = "\n\n".join(f"Paragraph {i} " + "word " * 40 for i in range(50))
+        chunks = chunk_markdown(text, 500)
+        self.assertGreater(len(chunks), 1)
+        for markdown, plain in chunks:
+            self.assertLessEqual(len(markdown), 500)
+            self.assertLessEqual(len(plain), 500)
+
+    def test_chunks_end_on_paragraph_boundaries(self):
+        paragraphs = [f"Paragraph {i}. " + "x" * 80 for i in range(20)]
+        chunks = chunk_markdown("\n\n".join(paragraphs), 400)
+        for _, plain in chunks:
+            self.assertTrue(plain.startswith("Paragraph "))
+            self.assertTrue(plain.endswith("x"))
+        self.assertEqual(
+            "\n\n".join(plain for _, plain in chunks).split("\n\n"), paragraphs
+        )
+
+    def test_split_code_block_is_closed_and_reopened(self):
+        code = "\n".join(f"    line_{i} = value * {i};" for i in range(100))
+        chunks = chunk_markdown(f"Intro\n```cpp\n{code}\n```\nOutro", 600)
+        self.assertGreater(len(chunks), 2)
+        for i, (markdown, _) in enumerate(chunks):
+            self.assertLessEqual(len(markdown), 600)
+            self.assertEqual(markdown.count("```") % 2, 0, markdown)
+            if 0 < i < len(chunks) - 1:
+                self.assertTrue(markdown.startswith("```cpp\n"))
+                self.assertTrue(markdown.endswith("\n```"))
+        # Code is never escaped
+        self.assertIn("line_1 = value * 1;", chunks[0][0] + chunks[1][0])
+
+    def test_overlong_fence_opening_line_is_split(self):
+        header = "Question 1:\n"
+        max_length = 4000 - len(header)
+        opening = "```cpp int main() { " + "x" * 3960
+        chunks = chunk_markdown(f"{opening}\n    more code();\n```\nDone", max_length)
+        self.assertGreater(len(chunks), 1)
+        for markdown, plain in chunks:
+            self.assertLessEqual(len(markdown), max_length)
+            self.assertLessEqual(len(plain), max_length)
+            self.assertEqual(markdown.count("```") % 2, 0, markdown[:50])
+        # Continuation chunks reopen the block with its language only
+        self.assertTrue(chunks[1][0].startswith("```cpp\n"))
+        self.assertIn("more code();", "".join(markdown for markdown, _ in chunks))
+
+    def test_overlong_line_is_split_on_spaces(self):
+        chunks = chunk_markdown("word " * 500, 200)
+        for markdown, _ in chunks:
+            self.assertLessEqual(len(markdown), 200)
+        self.assertEqual(" ".join(plain for _, plain in chunks).split(), ["word"] * 500)
+
+    def test_plain_version_is_the_original_text(self):
+        text = "Use **bold** and snake_case [here]"
+        [(markdown, plain)] = chunk_markdown(text, 100)
+        self.assertEqual(plain, text)
+        self.assertNotEqual(markdown, text)
+
+
+class EscapeLineTests(SimpleTestCase):
+    def test_github_bold_becomes_telegram_bold(self):
+        self.assertEqual(escape_line("**Answer**"), "*Answer*")
+
+    def test_underscores_inside_words_are_escaped(self):
+        self.assertEqual(escape_line("k_smallest"), "k\\_smallest")
+
+    def test_unbalanced_markers_are_escaped(self):
+        self.assertEqual(escape_line("2 * 3"), "2 \\* 3")
+        self.assertEqual(escape_line("a `b"), "a \\`b")
+
+    def test_links_and_inline_code_are_left_alone(self):
+        self.assertEqual(escape_line("[docs](https://example.com)"), "[docs](https://example.com)")
+        self.assertEqual(escape_line("call `k_smallest(*xs)` [1]"), "call `k_smallest(*xs)` \\[1]")
+
+    def test_escaped_markers_are_not_escaped_twice(self):
+        self.assertEqual(escape_line("2 \\* 3"), "2 \\* 3")
+
+
+class RecentUpdatesTests(SimpleTestCase):
+    def test_recorded_ids_are_recognised(self):
+        recent = RecentUpdates()
+        self.assertNotIn(42, recent)
+        recent.add(42)
+        recent.add(42)
+        self.assertIn(42, recent)
+        self.assertNotIn(43, recent)
+
+    def test_oldest_ids_are_forgotten(self):
+        recent = RecentUpdates(size=3)
+        for update_id in range(5):
+            recent.add(update_id)
+        self.assertEqual([update_id in recent for update_id in range(5)], [False, False, True, True, True])
+
+    def test_secret_matches(self):
+        self.assertTrue(secret_matches(None, None))
+        self.assertTrue(secret_matches("s3cret", "s3cret"))
+        self.assertTrue(secret_matches("s3cret", b"s3cret"))
+        self.assertFalse(secret_matches("s3cret", None))
+        self.assertFalse(secret_matches("s3cret", "wrong"))
+
+
+class LifecycleTests(SimpleTestCase):
+    async def pipeline(self, lifecycle, seconds, chat_id=1):
+        with lifecycle.running(PendingRun(chat_id, None, [])):
+            await asyncio.sleep(seconds)
+
+    async def test_drain_waits_for_work_that_finishes_in_time(self):
+        lifecycle = Lifecycle()
+        task = lifecycle.spawn(self.pipeline(lifecycle, 0.01))
+        self.assertEqual(await lifecycle.drain(1), [])
+        self.assertTrue(task.done() and not task.cancelled())
+        self.assertFalse(lifecycle.accepting)
+
+    async def test_only_cancelled_runs_are_returned(self):
+        lifecycle = Lifecycle()
+        lifecycle.spawn(self.pipeline(lifecycle, 0.01, chat_id=1))
+        slow = lifecycle.spawn(self.pipeline(lifecycle, 10, chat_id=2))
+        unfinished = await lifecycle.drain(0.1, grace=1)
+        self.assertEqual([run.chat_id for run in unfinished], [2])
+        self.assertTrue(slow.cancelled())
+        self.assertEqual(len(lifecycle), 0)
+
+    async def test_runs_outside_spawn_are_drained(self):
+        lifecycle = Lifecycle()
+        # Like a media group job started by the job queue
+        job = asyncio.create_task(self.pipeline(lifecycle, 10))
+        await asyncio.sleep(0)
+        unfinished = await lifecycle.drain(0.05, grace=1)
+        self.assertEqual(len(unfinished), 1)
+        self.assertTrue(job.cancelled())
+
+    async def test_work_started_during_the_drain_is_waited_for(self):
+        lifecycle = Lifecycle()
+        later = []
+
+        async def starts_another():
+            await asyncio.sleep(0.01)
+            later.append(lifecycle.spawn(self.pipeline(lifecycle, 0.05)))
+
+        lifecycle.spawn(starts_another())
+        self.assertEqual(await lifecycle.drain(1), [])
+        self.assertTrue(later[0].done() and not later[0].cancelled())
+
+
+class RateBudgetTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_path = os.path.join(directory.name, "ratelimit.sqlite3")
+
+    def budget(self, rpm=1000, tpm=1_000_000):
+        return RateBudget(self.db_path, {"openai": ("key", rpm, tpm)})
+
+    def reserve(self, budget, tokens, now):
+        with mock.patch("TelegramBot.ratelimit.time.time", return_value=now):
+            return budget._try_reserve(*budget.buckets["openai"], tokens)
+
+    def test_rpm_exhaustion_waits_for_the_oldest_request_to_expire(self):
+        budget = self.budget(rpm=2)
+        self.assertIsNotNone(self.reserve(budget, 1, 100)[0])
+        self.assertIsNotNone(self.reserve(budget, 1, 110)[0])
+        reservation, wait = self.reserve(budget, 1, 120)
+        self.assertIsNone(reservation)
+        self.assertAlmostEqual(wait, 40)
+        # Once the first request leaves the window there is room again
+        self.assertIsNotNone(self.reserve(budget, 1, 160.5)[0])
+
+    def test_tpm_exhaustion_frees_tokens_oldest_first(self):
+        budget = self.budget(tpm=100)
+        self.reserve(budget, 50, 100)
+        self.reserve(budget, 40, 110)
+
+        reservation, wait = self.reserve(budget, 30, 120)
+        self.assertIsNone(reservation)
+        self.assertAlmostEqual(wait, 40)  # the 50 tokens from t=100 are enough
+
+        reservation, wait = self.reserve(budget, 70, 120)
+        self.assertIsNone(reservation)
+        self.assertAlmostEqual(wait, 50)  # both earlier requests have to expire
+
+    def test_oversized_request_goes_through_on_an_idle_window(self):
+        budget = self.budget(tpm=100)
+        self.assertIsNotNone(self.reserve(budget, 500, 100)[0])
+        self.assertIsNone(self.reserve(budget, 1, 101)[0])
+
+    def test_settle_replaces_the_estimate(self):
+        budget = self.budget(tpm=100)
+        reservation, _ = self.reserve(budget, 90, 100)
+        self.assertIsNone(self.reserve(budget, 50, 101)[0])
+
+        budget._settle(reservation, 10)
+        self.assertIsNotNone(self.reserve(budget, 50, 102)[0])
+
+    def test_backoff_pauses_every_instance_sharing_the_database(self):
+        first, second = self.budget(), self.budget()
+        first._backoff(first.buckets["openai"][0], 130)
+
+        reservation, wait = self.reserve(second, 1, 100)
+        self.assertIsNone(reservation)
+        self.assertAlmostEqual(wait, 30)
+        self.assertIsNotNone(self.reserve(second, 1, 131)[0])
+
+    async def test_acquire_returns_a_reservation(self):
+        budget = self.budget()
+        reservation = await budget.acquire("openai", 10)
+        await budget.settle(reservation, 5)
+        self.assertIsNotNone(reservation)
+
+
+class FakeJob(concurrent.futures.Future):
+    """Behaves like a gradio_client 1.3.0 queue job: cancel() only flags it."""
+
+    def __init__(self, rank=None):
+        super().__init__()
+        self.rank = rank
+        self.cancel_requested = False
+
+    def status(self):
+        return mock.Mock(rank=self.rank, queue_size=5, eta=None)
+
+    def cancel(self):
+        self.cancel_requested = True
+        return True
+
+
+class FakeClient:
+    def __init__(self, space, verbose=False):
+        self.space = space
+        self.jobs = []
+
+    def submit(self, **kwargs):
+        job = FakeJob(rank=kwargs.get("rank"))
+        self.jobs.append(job)
+        return job
+
+
+class GradioPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.clients = []
+
+        def open_client(*args, **kwargs):
+            self.clients.append(FakeClient(*args, **kwargs))
+            return self.clients[-1]
+
+        patcher = mock.patch("TelegramBot.gradio_pool.Client", side_effect=open_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = GradioPool(max_idle_per_space=1, poll_interval=0.01)
+
+    async def test_result_is_returned_and_client_reused(self):
+        task = asyncio.create_task(self.pool.submit("space"))
+        await asyncio.sleep(0.05)
+        self.clients[0].jobs[0].set_result("answer")
+        self.assertEqual(await task, "answer")
+
+        task = asyncio.create_task(self.pool.submit("space"))
+        await asyncio.sleep(0.05)
+        self.clients[0].jobs[1].set_result("again")
+        self.assertEqual(await task, "again")
+        self.assertEqual(len(self.clients), 1)
+
+    async def test_idle_clients_are_capped(self):
+        tasks = [asyncio.create_task(self.pool.submit("space")) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        for client in self.clients:
+            client.jobs[0].set_result("done")
+        await asyncio.gather(*tasks)
+        self.assertEqual(len(self.clients), 2)
+        self.assertEqual(len(self.pool._idle["space"]), 1)
+
+    async def test_newer_job_from_the_same_owner_supersedes(self):
+        owner = ("chat", "user", ("photo",))
+        first = asyncio.create_task(self.pool.submit("space", owner=owner))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(self.pool.submit("space", owner=owner))
+        await asyncio.sleep(0.05)
+
+        stale = self.clients[0].jobs[0]
+        self.assertTrue(stale.cancel_requested)
+        # The stale job stops being awaited even though its future never completes
+        with self.assertRaises(JobSuperseded):
+            await asyncio.wait_for(first, 1)
+
+        self.clients[1].jobs[0].set_result("new")
+        self.assertEqual(await second, "new")
+        stale.set_result("late")
+        self.assertEqual(self.pool._superseded, set())
+        self.assertEqual(self.pool._active, {})
+
+    async def test_different_owners_do_not_supersede(self):
+        first = asyncio.create_task(self.pool.submit("space", owner=("chat", "user", ("photo1",))))
+        second = asyncio.create_task(self.pool.submit("space", owner=("chat", "user", ("photo2",))))
+        await asyncio.sleep(0.05)
+        for n, client in enumerate(self.clients):
+            self.assertFalse(client.jobs[0].cancel_requested)
+            client.jobs[0].set_result(n)
+        self.assertEqual(sorted(await asyncio.gather(first, second)), [0, 1])
+
+    async def test_status_is_reported_while_queued(self):
+        statuses = []
+
+        async def on_status(status):
+            statuses.append(describe_status(status))
+
+        task = asyncio.create_task(self.pool.submit("space", on_status=on_status, rank=2))
+        await asyncio.sleep(0.05)
+        self.clients[0].jobs[0].set_result("done")
+        await task
+        self.assertIn("Waiting in the model queue: position 3 of 5", statuses)
+
+
+class EchoBackend(backends.AnswerBackend):
+    name = "echo"
+
+    async def _answer(self, messages, model, **options):
+        return backends.Answer(self.flatten(messages), None)
+
+
+class BackendTests(SimpleTestCase):
+    async def test_stream_yields_the_whole_answer_without_native_streaming(self):
+        backend = EchoBackend()
+        pieces = [piece async for piece in backend.stream([{"role": "user", "content": "hi"}], "m")]
+        self.assertEqual(pieces, ["hi"])
+        self.assertEqual(backend.stats.summary()["calls"], 1)
+
+    async def test_gemini_takes_the_system_prompt_and_image_content(self):
+        response = mock.Mock(text="answer", usage_metadata=None)
+        with mock.patch("TelegramBot.backends.genai.GenerativeModel") as generative_model:
+            generative_model.return_value.generate_content.return_value = response
+            answer = await backends.GeminiBackend().answer(
+                [
+                    {"role": "system", "content": "be brief"},
+                    {"role": "user", "content": ["read this", "file"]},
+                ],
+                "gemini-1.5-pro-latest",
+            )
+
+        self.assertEqual(answer.text, "answer")
+        generative_model.assert_called_once_with(
+            model_name="gemini-1.5-pro-latest", system_instruction="be brief"
+        )
+        generative_model.return_value.generate_content.assert_called_once_with(["read this", "file"])
+
+
+class WaitForModelTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch("TelegramBot.views.store.last_model", mock.AsyncMock(return_value=None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def choose(self, chat_data, model):
+        # What button_handler does with a valid choice
+        chat_data["selected_model"] = model
+        chat_data.pop("model_selected").set()
+
+    async def test_timed_out_waiter_leaves_the_choice_to_the_others(self):
+        chat_data = {}
+        with mock.patch("TelegramBot.views.MODEL_CHOICE_TIMEOUT", 0.05):
+            first = asyncio.create_task(views.wait_for_model(chat_data, 1))
+            await asyncio.sleep(0.03)
+            second = asyncio.create_task(views.wait_for_model(chat_data, 1))
+            with self.assertRaises(asyncio.TimeoutError):
+                await first
+            self.choose(chat_data, "o1")
+            self.assertEqual(await second, "o1")
+        self.assertNotIn("model_selected", chat_data)
+
+    async def test_last_waiter_to_time_out_forgets_the_question(self):
+        chat_data = {}
+        with mock.patch("TelegramBot.views.MODEL_CHOICE_TIMEOUT", 0.01):
+            with self.assertRaises(asyncio.TimeoutError):
+                await views.wait_for_model(chat_data, 1)
+        self.assertNotIn("model_selected", chat_data)
+
+    async def test_choice_made_as_the_wait_runs_out_is_used(self):
+        chat_data = {}
+
+        async def chosen_too_late(waiting, timeout):
+            waiting.close()
+            chat_data["selected_model"] = "o1mini"  # set without releasing the waiter
+            raise asyncio.TimeoutError
+
+        with mock.patch("TelegramBot.views.asyncio.wait_for", side_effect=chosen_too_late):
+            self.assertEqual(await views.wait_for_model(chat_data, 1), "o1mini")
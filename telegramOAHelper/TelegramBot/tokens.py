@@ -0,0 +1,31 @@
+# bot_app/tokens.py
+
+# Rough token estimates used to schedule and budget requests before they are sent.
+# They only need to be in the right ballpark; real usage is read back from the
+# provider responses where available.
+
+CHARS_PER_TOKEN = 4
+
+# Gemini bills a fixed number of tokens per image regardless of resolution
+IMAGE_TOKEN_ESTIMATE = 258
+
+# Expected output sizes for the two pipeline stages
+EXTRACTION_OUTPUT_ESTIMATE = 1024
+ANSWER_OUTPUT_ESTIMATE = 4096  # reasoning models spend a lot on hidden tokens
+
+
+# Helper function to estimate the token count of a piece of text
+def estimate_tokens(text):
+    if not text:
+        return 0
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+# Estimated cost of the Gemini extraction stage for a batch of images
+def estimate_extraction_tokens(prompt, image_count):
+    return (
+        estimate_tokens(prompt)
+        + image_count * IMAGE_TOKEN_ESTIMATE
+        + EXTRACTION_OUTPUT_ESTIMATE
+    )
+
@@ -0,0 +1,50 @@
+# bot_app/updates.py
+
+import hmac
+import json
+from collections import deque
+
+# orjson parses the raw request bytes noticeably faster; it is optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(body):
+    """Decode a JSON request body straight from bytes."""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+# Helper function to compare the X-Telegram-Bot-Api-Secret-Token header in constant time
+def secret_matches(expected, received):
+    if not expected:
+        return True
+    if received is None:
+        return False
+    if isinstance(received, str):
+        received = received.encode()
+    return hmac.compare_digest(expected.encode(), received)
+
+
+class RecentUpdates:
+    """Ring buffer of the last ``size`` update ids, used to drop redeliveries."""
+
+    def __init__(self, size=1024):
+        self._order = deque()
+        self._ids = set()
+        self.size = size
+
+    def __contains__(self, update_id):
+        return update_id in self._ids
+
+    def add(self, update_id):
+        """Record ``update_id``; call it only once the update has been handed off."""
+        if update_id in self._ids:
+            return
+        self._ids.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.size:
+            self._ids.discard(self._order.popleft())
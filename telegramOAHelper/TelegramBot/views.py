@@ -4,20 +4,39 @@ import os
 import logging
 import json  # For parsing JSON data
 import asyncio  # For asyncio primitives
+from django.conf import settings
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Update
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
     MessageHandler, filters, ContextTypes
 )
 import google.generativeai as genai
-import tempfile
-from gradio_client import Client
 from dotenv import load_dotenv
 import json
 
+from . import store
+from .albums import AlbumBuffer, AlbumPhoto
+from .backends import OpenAIBackend, GeminiBackend
+from .helpers import (
+    ModelChoice, buffer_album_photo, button_handler, model_keyboard, send_markdown, start, upload_photo
+)
+from .lifecycle import Lifecycle, PendingRun
+from .ratelimit import RateBudget
+from .scheduler import FairScheduler, AdmissionError
+from .singleflight import SingleFlight, normalize_question
+from .prompts import get_template
+from .tokens import estimate_extraction_tokens, ANSWER_OUTPUT_ESTIMATE
+from .updates import RecentUpdates, loads, secret_matches
+
 MAX_MESSAGE_LENGTH = 4000
+MODEL_CHOICE_TIMEOUT = int(os.getenv("MODEL_CHOICE_TIMEOUT", "300"))  # seconds
+HISTORY_LENGTH = 10
+DELIVERY_ATTEMPTS = 3
+RESULT_RETENTION_DAYS = int(os.getenv("RESULT_RETENTION_DAYS", "30"))
+SHUTDOWN_DRAIN_TIMEOUT = int(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "25"))  # seconds
 
 # Load environment variables from .env file
 load_dotenv()
@@ -27,6 +46,9 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# Must match the secret_token passed to setWebhook; requests without it are rejected
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+
 # Configure the Google GenAI API with the provided key.
 genai.configure(api_key=GOOGLE_API_KEY)
 
@@ -49,64 +71,11 @@ application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
 application_initialized = False
 application_lock = asyncio.Lock()
 
+# Update ids handled recently, so redeliveries from Telegram are processed once
+recent_updates = RecentUpdates()
 
-# Helper function to split messages
-def split_message(text, max_length):
-    return [text[i:i + max_length] for i in range(0, len(text), max_length)]
-
-
-# Start command handler
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("Use o1", callback_data="o1")],
-        [InlineKeyboardButton("Use o1mini", callback_data="o1mini")],
-        [InlineKeyboardButton("Use ChatGPT4", callback_data="ChatGPT4")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    await update.message.reply_text(
-        "Choose the model you want to use to process the image analysis output:",
-        reply_markup=reply_markup,
-    )
-
-
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-
-    selected_model = query.data
-    context.chat_data["selected_model"] = selected_model  # Use chat_data instead
-
-    if selected_model in models:
-        await query.edit_message_text(
-            f"You selected {selected_model}. Please upload an image for analysis."
-        )
-    else:
-        await query.edit_message_text("Model selection failed!")
-
-
-# Helper function to upload image to GenAI
-async def upload_image_to_genai(file):
-    # Create a temporary file
-    fd, temp_file_path = tempfile.mkstemp(suffix=".jpg")
-    os.close(fd)  # Close the file descriptor
-
-    try:
-        # Download the file from Telegram to the temporary file
-        await file.download_to_drive(temp_file_path)
-
-        # Upload the file to GenAI
-        sample_file = genai.upload_file(
-            path=temp_file_path, display_name="Uploaded Image"
-        )
-        logging.info(
-            f"Uploaded file '{sample_file.display_name}' as: {sample_file.uri}"
-        )
-        return sample_file
-    finally:
-        # Clean up: remove the temporary file
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+# In-flight update tasks and pipeline runs, drained on shutdown
+lifecycle = Lifecycle()
 
 
 import json
@@ -143,14 +112,235 @@ def extract_json_from_text(json_string):
         # Return None in case of any error
         return None
 
-from openai import OpenAI
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Backend that answers the extracted questions
+answer_backend = OpenAIBackend(OPENAI_API_KEY)
+
+# Backend that reads the questions off the photos
+extraction_backend = GeminiBackend()
+EXTRACTION_MODEL = "gemini-1.5-pro-latest"
+
+EXTRACTION_PROMPT = '''Please analyze the image(s) provided and generate a detailed text-based question. This question should include all relevant information visible in the image, such as any text, symbols, and visual context. Ensure the question is fully comprehensive and includes any specific details that could be relevant to solving it, such as edge cases, input formats, and any assumptions that might need to be made based on the image content. The question should be self-contained, meaning that someone (or another AI) reading it should have all the information necessary to answer the question without seeing the image. Your output should be clear and well-structured, ideally in a single paragraph, to facilitate easy understanding and processing by another AI model.
+
+
+
+Return the response in the following JSON format:
+
+
+
+```
+
+{
+ "1": "First question based on the image.",
+"2": "Second question based on the image.\\n second line of second question",
+"3": "Third question based on the image.",
+"...": "..."
+}
+```
+IMPORTANT : the json format should be such that I can directly use json.loads function in python, always use double quots and instead of a single slash for use "\\" example "\\n"
+
+Write exactly what is presented without adding explanations or interpretations. If the image contains multiple questions, clearly separate each one as '1', '2', and so on, ensuring that each question is distinct and correctly formatted in the JSON structure.'''
+
+
+# Fair-share scheduler in front of the Gemini extraction and answering stages
+scheduler = FairScheduler(
+    max_concurrent=int(os.getenv("SCHEDULER_MAX_CONCURRENT", "4")),
+    per_key_concurrency=int(os.getenv("SCHEDULER_PER_USER_CONCURRENCY", "1")),
+    per_key_max_pending=int(os.getenv("SCHEDULER_PER_USER_MAX_PENDING", "5")),
+    token_budget=int(os.getenv("SCHEDULER_PER_USER_TOKEN_BUDGET", "200000")),
+    budget_window=int(os.getenv("SCHEDULER_BUDGET_WINDOW", "3600")),
+)
+
+# Photos of albums that are still arriving, shared by all chats
+album_buffer = AlbumBuffer(
+    max_albums=int(os.getenv("ALBUM_BUFFER_MAX_ALBUMS", "1000")),
+    max_age=int(os.getenv("ALBUM_BUFFER_MAX_AGE", "120")),
+)
+ALBUM_SWEEP_INTERVAL = 60
+
+# Identical uploads, extractions and answers that are already running get shared
+inflight = SingleFlight()
+
+# Answer prompt; the fixed instructions go in a system message ahead of the question
+answer_template = get_template("answer", os.getenv("ANSWER_TEMPLATE_VERSION"))
+
+# Provider-wide RPM/TPM budget, shared by every worker process through SQLite
+rate_budget = RateBudget(
+    os.getenv("RATE_LIMIT_DB", settings.BASE_DIR / "ratelimit.sqlite3"),
+    {
+        "openai": (OPENAI_API_KEY, int(os.getenv("OPENAI_RPM", "500")), int(os.getenv("OPENAI_TPM", "30000"))),
+        "gemini": (GOOGLE_API_KEY, int(os.getenv("GEMINI_RPM", "360")), int(os.getenv("GEMINI_TPM", "4000000"))),
+    },
+)
+
+RATE_LIMIT_ERRORS = {
+    backend.provider: backend.rate_limit_errors for backend in (answer_backend, extraction_backend)
+}
+DEFAULT_RETRY_AFTER = 20
+
+
+# Helper function to read the provider's suggested wait out of a 429
+def get_retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", DEFAULT_RETRY_AFTER))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+# Await a provider call, paced by the shared rate budget
+async def call_with_budget(provider, tokens, get_usage, func, *args, **kwargs):
+    for attempt in range(2):
+        reservation = await rate_budget.acquire(provider, tokens)
+        try:
+            result = await func(*args, **kwargs)
+        except RATE_LIMIT_ERRORS[provider] as e:
+            # A rejected request used no tokens; it still counts against the RPM limit
+            await rate_budget.settle(reservation, 0)
+            # Pause every worker, then let the budget decide when to try again
+            await rate_budget.backoff(provider, get_retry_after(e))
+            if attempt:
+                raise
+            continue
+        await rate_budget.settle(reservation, get_usage(result))
+        return result
+
+
+def answer_usage(answer):
+    return answer.usage.total_tokens if answer.usage is not None else None
+
+
+# Upload a batch of photos and run the Gemini extraction on them
+async def extract_questions(bot, photos, schedule_key, extraction_cost, on_queued, on_start):
+    async with scheduler.slot(schedule_key, extraction_cost, on_queued=on_queued):
+        on_start()
+        # The same photo forwarded into several chats is only uploaded once
+        uploaded_files = await asyncio.gather(*(
+            inflight.do(("upload", photo.file_unique_id), upload_photo, bot, photo.file_id)
+            for photo in photos
+        ))
+
+        # The prompt and the uploaded photos go to Gemini as one message
+        messages = [{"role": "user", "content": [EXTRACTION_PROMPT] + list(uploaded_files)}]
+        answer = await call_with_budget(
+            extraction_backend.provider, extraction_cost, answer_usage,
+            extraction_backend.answer, messages, EXTRACTION_MODEL,
+        )
+
+    scheduler.record_usage(schedule_key, extraction_cost, answer_usage(answer))
+    return answer.text
+
+
+# The chat's model choice; chat_data is lost on restart, so fall back to the model of its last answer
+async def chat_model(chat_data, chat_id):
+    model = chat_data.get("selected_model")
+    if model not in models:
+        model = await store.last_model(chat_id)
+        if model not in models:
+            return None
+        chat_data["selected_model"] = model
+    return model
+
+
+# Wait until the chat has chosen a model; the chat's last choice is used when there is one
+async def wait_for_model(chat_data, chat_id):
+    if await chat_model(chat_data, chat_id) is None:
+        model_selected = chat_data.setdefault("model_selected", ModelChoice())
+        model_selected.waiters += 1
+        try:
+            await asyncio.wait_for(model_selected.wait(), MODEL_CHOICE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # The choice may have landed just as the wait ran out
+            if await chat_model(chat_data, chat_id) is None:
+                raise
+        finally:
+            model_selected.waiters -= 1
+            # Other pipelines may still be waiting on it; once none are, the next image asks again
+            if not model_selected.waiters and chat_data.get("model_selected") is model_selected:
+                del chat_data["model_selected"]
+    return chat_data["selected_model"]
+
+
+# Answer a single extracted question with the selected model
+async def answer_question(question_number, question_text, selected_model, schedule_key, on_queued, on_start):
+    prompt_messages = answer_template.build(
+        question_number=question_number, question_text=question_text
+    )
+
+    answer_cost = answer_template.estimate(prompt_messages) + ANSWER_OUTPUT_ESTIMATE
+    async with scheduler.slot(schedule_key, answer_cost, on_queued=on_queued):
+        on_start()
+        answer = await call_with_budget(
+            answer_backend.provider, answer_cost, answer_usage,
+            answer_backend.answer, prompt_messages, models[selected_model],
+        )
+    # Answers are charged once their real size is known
+    scheduler.record_usage(schedule_key, 0, answer_usage(answer))
+    answer_template.record(prompt_messages, answer.usage)
+
+    return answer.text
+
+
+# Send a stored answer to the chat and remember that it arrived
+async def deliver_answer(bot, answer):
+    await bot.send_message(
+        chat_id=answer.chat_id,
+        text=f"QUESTION {answer.question_number} : {answer.question_text} done using {answer.model}"
+    )
+
+    await send_markdown(
+        bot, answer.chat_id, answer.answer_text, MAX_MESSAGE_LENGTH,
+        header="ANSWER\n------------------------\n\n",
+        footer="\n\n----------------------------",
+    )
+
+    await store.mark_delivered(answer)
+
+
+# Deliver a stored answer, retrying when Telegram fails; returns whether it arrived
+async def deliver_with_retry(bot, answer):
+    for attempt in range(DELIVERY_ATTEMPTS):
+        try:
+            await deliver_answer(bot, answer)
+            return True
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except TelegramError as e:
+            logging.error(f"Error delivering answer {answer.pk} (attempt {attempt + 1}): {e}")
+            await asyncio.sleep(2 ** attempt)
+    return False
 
-async def process_images(context, messages, selected_model, chat_id):
+
+async def process_images(context, photos, chat_id, user_id=None, run=None):
+    # Users are scheduled individually; fall back to the chat for anonymous senders
+    schedule_key = user_id or chat_id
+    extraction_cost = estimate_extraction_tokens(EXTRACTION_PROMPT, len(photos))
+
+    # Registered with the lifecycle so a shutdown can checkpoint it
+    if run is None:
+        run = PendingRun(chat_id, user_id, photos)
+
+    try:
+        with scheduler.admission(schedule_key, extraction_cost), lifecycle.running(run):
+            await run_pipeline(
+                context, run, schedule_key, extraction_cost
+            )
+    except AdmissionError as e:
+        await context.bot.send_message(chat_id=chat_id, text=str(e))
+
+
+async def run_pipeline(context, run, schedule_key, extraction_cost):
+    photos, chat_id = run.photos, run.chat_id
+    chat_data = context.application.chat_data[chat_id]
+    interrupted = False
+
+    # The model is only needed for answering, so it is looked up once extraction is done
+    selected_model = None
+    status_text = "Processing your image(s)"
 
     status_message = await context.bot.send_message(
         chat_id=chat_id,
-        text=f"Processing your image(s) with the {selected_model} model..."
+        text=f"{status_text}..."
     )
 
     # Start a background task to update the status message periodically
@@ -159,9 +349,7 @@ async def process_images(context, messages, selected_model, chat_id):
         while not getattr(update_status, 'done', False):
             await asyncio.sleep(1)  # Update every 5 seconds
             try:
-                await status_message.edit_text(
-                    f"Processing your image(s) with the {selected_model} model{'.' * dots}"
-                )
+                await status_message.edit_text(f"{status_text}{'.' * dots}")
                 dots = (dots % 7) + 1
             except Exception as e:
                 logging.error(f"Error updating status message: {e}")
@@ -169,113 +357,113 @@ async def process_images(context, messages, selected_model, chat_id):
 
     status_task = asyncio.create_task(update_status())
 
-    try:
-        uploaded_files = []
-        for message in messages:
-            photos = message.photo
-            photo = photos[-1]  # Get the highest resolution photo
-            file = await context.bot.get_file(photo.file_id)
-            uploaded_file = await upload_image_to_genai(file)
-            uploaded_files.append(uploaded_file)
-
-        # Use the GenAI model for analysis
-        model = genai.GenerativeModel(model_name="gemini-1.5-pro-latest")
-        prompt = '''Please analyze the image(s) provided and generate a detailed text-based question. This question should include all relevant information visible in the image, such as any text, symbols, and visual context. Ensure the question is fully comprehensive and includes any specific details that could be relevant to solving it, such as edge cases, input formats, and any assumptions that might need to be made based on the image content. The question should be self-contained, meaning that someone (or another AI) reading it should have all the information necessary to answer the question without seeing the image. Your output should be clear and well-structured, ideally in a single paragraph, to facilitate easy understanding and processing by another AI model.
+    # Let the user know where they stand when the scheduler makes them wait
+    # Called again whenever the position changes; update_status shows it within a second
+    async def report_queue_position(position):
+        nonlocal status_text
+        status_text = f"Waiting in queue (position {position})"
 
+    def resume_status():
+        nonlocal status_text
+        if selected_model is None:
+            status_text = "Processing your image(s)"
+        else:
+            status_text = f"Processing your image(s) with the {selected_model} model"
 
+    try:
+        # Images we have seen before are replayed from the database without any upstream call
+        image_hash = store.hash_images(photos)
+        extraction = await store.find_extraction(image_hash)
+
+        if extraction is None:
+            # Students forwarding the same album at once share a single extraction
+            gemini_output = await inflight.do(
+                ("extract", tuple(photo.file_unique_id for photo in photos)),
+                extract_questions,
+                context.bot, photos, schedule_key, extraction_cost, report_queue_position, resume_status,
+            )
 
-Return the response in the following JSON format:
-
-
-
-```
-
-{
- "1": "First question based on the image.",
-"2": "Second question based on the image.\\n second line of second question",
-"3": "Third question based on the image.",
-"...": "..."
-}
-```
-IMPORTANT : the json format should be such that I can directly use json.loads function in python, always use double quots and instead of a single slash for use "\\" example "\\n"
-
-Write exactly what is presented without adding explanations or interpretations. If the image contains multiple questions, clearly separate each one as '1', '2', and so on, ensuring that each question is distinct and correctly formatted in the JSON structure.'''
+            json_questions = extract_json_from_text(gemini_output)
 
-        # Run the blocking call in a separate thread
-        response = await asyncio.to_thread(model.generate_content, [prompt] + uploaded_files)
-        gemini_output = response.text  # Adjust according to actual response format
 
-        json_questions = extract_json_from_text(gemini_output)
+            if json_questions is None:
+                # Handle the case where JSON extraction failed
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text="Failed to extract questions from the image analysis. Please try again." + gemini_output
+                )
+                await status_message.edit_text("Processing complete.")
+                return
 
+            extraction = await store.save_extraction(image_hash, chat_id, json_questions)
+        json_questions = extraction.questions
 
-        if json_questions is None:
-            # Handle the case where JSON extraction failed
+        # Picked up here rather than when the photo arrived, so a model change mid-album counts
+        if await chat_model(chat_data, chat_id) is None:
+            status_text = "Waiting for you to choose a model"
+        try:
+            selected_model = await wait_for_model(chat_data, chat_id)
+        except asyncio.TimeoutError:
             await context.bot.send_message(
                 chat_id=chat_id,
-                text="Failed to extract questions from the image analysis. Please try again." + gemini_output
+                text="No model was selected, so the questions were not answered. Choose one with "
+                     "/start and send the image(s) again; they will not need to be read again."
             )
             await status_message.edit_text("Processing complete.")
             return
+        run.model = selected_model
+        resume_status()
 
         for question_number, question_text in json_questions.items():
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f'''**EXTRACTED QUESTIONS**: 
-                
-                 ```question {question_number} :
-                 {question_text}```
-                
-                ''',
-                parse_mode = 'Markdown'
+            # Questions delivered before a restart are not sent again
+            if question_number in run.delivered:
+                continue
+
+            await send_markdown(
+                context.bot, chat_id,
+                f"```\nquestion {question_number} :\n{question_text}\n```",
+                MAX_MESSAGE_LENGTH,
+                header="EXTRACTED QUESTIONS:\n\n",
             )
             # Process each question with only the selected model
             try:
-                inputs = f'''Deliver your answer clearly and concisely:
-
-                    1. **For multiple-choice questions (MCQs)**, only provide the correct option number and option value, also Encapsulate the option using triple backticks (```) to enhance readability (e.g., "```Answer: B <option value>```") without any additional explanation unless specified.
-                    
-                    2. **For questions involving code**, use C++ and format your code clearly. Encapsulate code segments using triple backticks (```) to enhance readability.
-                    
-                    3. **For non-code questions** that require explanations, provide a straightforward answer give code block only if needed.
-                    
-                    Answer the question in a format that is precise, directly addresses the specifics, and is easy to read in a Telegram message.
-                    
-                    Question {question_number}: {question_text}'''
-
-                completion = client.chat.completions.create(
-                    model=models[selected_model],
-                    messages=[
-                        {"role": "user", "content": inputs}
-                    ],
-                    # temperature=0.5,
-                    # top_p=0.9
-                )
-                
-                message_text = completion.choices[0].message.content
-
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"QUESTION {question_number} : {question_text} done using {selected_model}"
-                )
+                # An image this chat sent before reuses its stored answer row
+                answer = await store.find_chat_answer(extraction, chat_id, question_number, selected_model)
+                if answer is None:
+                    message_text = await store.find_answer(question_text, selected_model)
+                    if message_text is None:
+                        message_text = await inflight.do(
+                            ("answer", selected_model, normalize_question(question_text)),
+                            answer_question,
+                            question_number, question_text, selected_model, schedule_key,
+                            report_queue_position, resume_status,
+                        )
+
+                    # Store the answer before sending it so a failed send can be replayed with /resend
+                    answer = await store.save_answer(
+                        extraction, chat_id, question_number, question_text, selected_model, message_text
+                    )
 
-                message_chunks = split_message(message_text, MAX_MESSAGE_LENGTH)
-                for chunk in message_chunks:
+                if not await deliver_with_retry(context.bot, answer):
                     await context.bot.send_message(
                         chat_id=chat_id,
-                        text=f'''
-                        ANSWER
-                        ------------------------
-                        
-                        
-                        {chunk}
-                        
-                        ----------------------------''',
-                        parse_mode='Markdown'
+                        text=f"Question {question_number} was answered, but sending the answer failed. "
+                             f"Use /resend to get it."
                     )
+                    continue
+                run.delivered.append(question_number)
 
                 # Update the status message
                 await status_message.edit_text(f"Processed question {question_number} successfully.")
 
+            except answer_backend.rate_limit_errors as e:
+                logging.error(f"Rate limited processing question {question_number} with {selected_model}: {e}")
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text=f"The {selected_model} model is busy right now, so question {question_number} "
+                         f"could not be answered. Please try again in a minute."
+                )
+
             except Exception as e:
                 logging.error(f"Error processing question {question_number} with {selected_model}: {e}")
                 await context.bot.send_message(
@@ -286,15 +474,26 @@ Write exactly what is presented without adding explanations or interpretations.
         # After all questions are processed, edit the status message
         await status_message.edit_text("Processing complete.")
 
+    except asyncio.CancelledError:
+        # Cut short by a shutdown; the checkpoint lets the next instance finish the job
+        interrupted = True
+        raise
+
     finally:
         update_status.done = True
         await status_task
 
-        # Inform the user that they need to start over
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="Processing complete. "
-        )
+        if interrupted:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="The bot is restarting. Your image(s) will be picked up again in a moment."
+            )
+        else:
+            # Inform the user that they need to start over
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="Processing complete. "
+            )
 
 
 # Function to handle image uploads
@@ -306,83 +505,89 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user and update.message.from_user.is_bot:
         return
 
-    if "selected_model" not in context.chat_data:  # Use chat_data here
+    chat_id = update.effective_chat.id
+
+    # Start reading the image right away and ask for a model in the meantime
+    if "model_selected" not in context.chat_data and await chat_model(context.chat_data, chat_id) is None:
+        context.chat_data["model_selected"] = ModelChoice()
         await update.message.reply_text(
-            "Please select a model first using the /start command."
+            "I'm already reading your image(s). Choose the model that should answer the questions:",
+            reply_markup=model_keyboard(),
         )
-        return
 
-    selected_model = context.chat_data["selected_model"]  # And here
-
-    chat_id = update.effective_chat.id
-
-    # Initialize media_groups and media_group_jobs in context.chat_data if not present
-    if 'media_groups' not in context.chat_data:
-        context.chat_data['media_groups'] = {}
-    if 'media_group_jobs' not in context.chat_data:
-        context.chat_data['media_group_jobs'] = {}
+    user_id = update.effective_user.id
+    photo = AlbumPhoto.from_photo_size(update.message.photo[-1])  # Get the highest resolution photo
 
     media_group_id = update.message.media_group_id
 
     if media_group_id:
-        # This message is part of a media group
-        if media_group_id not in context.chat_data['media_groups']:
-            context.chat_data['media_groups'][media_group_id] = []
-
-        context.chat_data['media_groups'][media_group_id].append(update.message)
-
-
-        if media_group_id in context.chat_data['media_group_jobs']:
-            context.chat_data['media_group_jobs'][media_group_id].schedule_removal()
-
-        # Schedule a new job to process this media group after 2 seconds
-        job = context.application.job_queue.run_once(
-            process_media_group,
-            when=2,  # seconds
-            data={
-                'media_group_id': media_group_id,
-                'selected_model': selected_model,
-                'chat_id': chat_id,
-            },
-            user_id=update.effective_user.id,
-            chat_id=chat_id,
-        )
-        # Store the job so we can cancel/reschedule it if needed
-        context.chat_data['media_group_jobs'][media_group_id] = job
+        # This message is part of a media group, processed once the album goes quiet
+        buffer_album_photo(context, album_buffer, process_media_group, photo, chat_id, user_id, media_group_id)
     else:
 
         await process_images(
-            context, [update.message], selected_model, chat_id
+            context, [photo], chat_id, user_id=user_id,
         )
 
 
 # Function to process media group after waiting
 async def process_media_group(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    job_data = job.data
-    media_group_id = job_data['media_group_id']
-    selected_model = job_data['selected_model']
-    chat_id = job_data['chat_id']
+    album = album_buffer.pop(context.job.data)
 
-    # Retrieve the stored messages (photos)
-    chat_data = context.application.chat_data.get(chat_id, {})
-    media_groups = chat_data.get('media_groups', {})
-    messages = media_groups.pop(media_group_id, [])
-
-    # Remove the job from media_group_jobs
-    media_group_jobs = chat_data.get('media_group_jobs', {})
-    media_group_jobs.pop(media_group_id, None)
-
-    if messages:
+    if album and album.photos:
 
         await process_images(
-            context, messages, selected_model, chat_id=chat_id
+            context, album.photos, chat_id=album.chat_id, user_id=album.user_id
         )
 
 
-# Webhook view to receive updates from Telegram
-@csrf_exempt
-async def webhook(request):
+# Command handler listing the most recent answers in this chat
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    answers = await store.recent_answers(update.effective_chat.id, HISTORY_LENGTH)
+    if not answers:
+        await update.message.reply_text("No answers stored for this chat yet.")
+        return
+
+    lines = []
+    for answer in answers:
+        question = answer.question_text if len(answer.question_text) <= 80 else answer.question_text[:77] + "..."
+        lines.append(f"{answer.created_at:%Y-%m-%d %H:%M} - Q{answer.question_number} ({answer.model}): {question}")
+    await update.message.reply_text(
+        "Recent answers (use /resend to get them again):\n\n" + "\n".join(lines)
+    )
+
+
+# Command handler re-sending stored answers without calling any model
+async def resend(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    answers = await store.answers_to_resend(update.effective_chat.id)
+    if not answers:
+        await update.message.reply_text("There is nothing to re-send in this chat.")
+        return
+
+    for answer in answers:
+        if not await deliver_with_retry(context.bot, answer):
+            await update.message.reply_text(
+                f"Failed to re-send question {answer.question_number}. Please try again later."
+            )
+
+
+# Daily cleanup of stored extractions and answers
+async def prune_results(context: ContextTypes.DEFAULT_TYPE):
+    await store.prune(RESULT_RETENTION_DAYS)
+
+
+# Periodically drop albums whose flush job never fired and report buffer usage
+async def sweep_albums(context: ContextTypes.DEFAULT_TYPE):
+    album_buffer.sweep()
+    stats = album_buffer.stats()
+    logging.info(
+        f"Album buffer: {stats['albums']} album(s), {stats['photos']} photo(s), "
+        f"~{stats['bytes']} bytes, {stats['evicted']} evicted"
+    )
+
+
+# Initialize the application on the first update
+async def ensure_application_initialized():
     global application_initialized
     if not application_initialized:
         # Ensure that only one coroutine initializes the application
@@ -390,22 +595,111 @@ async def webhook(request):
             if not application_initialized:
                 await application.initialize()
                 application.job_queue.scheduler.start()
+                application.job_queue.run_repeating(sweep_albums, interval=ALBUM_SWEEP_INTERVAL)
+                application.job_queue.run_repeating(prune_results, interval=24 * 60 * 60, first=60)
                 application_initialized = True
 
+                # Pick up the work a previous instance checkpointed on its way down
+                lifecycle.spawn(resume_checkpoints())
+
+
+# Restart the pipeline runs checkpointed by a previous instance. Stored
+# extractions and answers mean finished steps are replayed without upstream calls.
+async def resume_checkpoints():
+    runs = await store.take_checkpoints()
+    if runs:
+        logging.info(f"Resuming {len(runs)} checkpointed run(s)")
+
+    for run in runs:
+        context = application.context_types.context(application, chat_id=run.chat_id, user_id=run.user_id)
+        chat_data = application.chat_data[run.chat_id]
+
+        if run.model is not None:
+            chat_data.setdefault("selected_model", run.model)
+        elif "model_selected" not in chat_data and await chat_model(chat_data, run.chat_id) is None:
+            chat_data["model_selected"] = ModelChoice()
+            await application.bot.send_message(
+                chat_id=run.chat_id,
+                text="I'm picking up your image(s) again. Choose the model that should answer the questions:",
+                reply_markup=model_keyboard(),
+            )
+
+        lifecycle.spawn(process_images(context, run.photos, run.chat_id, user_id=run.user_id, run=run))
+
+
+# Stop taking updates, let in-flight pipelines finish and checkpoint whatever does not
+async def shutdown():
+    lifecycle.accepting = False
+
+    # No media group job may start a run that the drain would not wait for
+    if application_initialized:
+        application.job_queue.scheduler.pause()
+
+    # Update tasks still in handle_image can add photos to the album buffer, so they go first
+    runs = await lifecycle.drain(SHUTDOWN_DRAIN_TIMEOUT)
+
+    # Albums still being collected are handed over as they are
+    for album in album_buffer.drain():
+        if album.job is not None:
+            album.job.schedule_removal()
+        if album.photos:
+            runs.append(PendingRun(album.chat_id, album.user_id, album.photos))
+
+    if runs:
+        await store.save_checkpoints(runs)
+        logging.info(f"Checkpointed {len(runs)} unfinished run(s)")
+
+    if application_initialized:
+        application.job_queue.scheduler.shutdown(wait=False)
+        await application.shutdown()
+
+
+# Hand a decoded update to the application in the background
+async def dispatch_update(data):
+    await ensure_application_initialized()
+
+    # Parse the JSON data into an Update object
+    update = Update.de_json(data, application.bot)
+
+    # Recorded only once the task exists, so a retry after a failure above is not
+    # dropped as a duplicate; nothing awaits between the check and the record
+    if update.update_id in recent_updates:
+        logging.info(f"Dropping duplicate update {update.update_id}")
+        return
+
+    # Process the update with the application; tracked so a shutdown can wait for it
+    lifecycle.spawn(application.process_update(update))
+    recent_updates.add(update.update_id)
+
+
+# Webhook view to receive updates from Telegram. Under ASGI, updates are
+# normally answered by fastpath.py before they reach Django at all.
+@csrf_exempt
+async def webhook(request):
     if request.method == 'POST':
-        # Retrieve the JSON update from Telegram
-        request_body = request.body  # Do not await request.body
+        # Reject anything that does not carry our secret before parsing it
+        if not secret_matches(TELEGRAM_WEBHOOK_SECRET, request.headers.get("X-Telegram-Bot-Api-Secret-Token")):
+            return HttpResponse(status=403)
+
+        # While shutting down, let Telegram redeliver the update to the next instance
+        if not lifecycle.accepting:
+            return HttpResponse(status=503)
+
         try:
-            data = json.loads(request_body.decode('utf-8'))  # Parse JSON data
-        except json.JSONDecodeError as e:
+            data = loads(request.body)  # Do not await request.body
+        except ValueError as e:
             logging.error(f"Failed to parse JSON: {e}")
             return HttpResponse(status=400)  # Return 400 Bad Request if JSON is invalid
 
-        # Parse the JSON data into an Update object
-        update = Update.de_json(data, application.bot)
+        if not isinstance(data, dict):
+            return HttpResponse(status=400)
 
-        # Process the update with the application
-        asyncio.create_task(application.process_update(update))
+        try:
+            await dispatch_update(data)
+        except Exception as e:
+            # Not acknowledged, so Telegram delivers the update again
+            logging.error(f"Failed to dispatch update {data.get('update_id')}: {e}")
+            return HttpResponse(status=500)
         return HttpResponse(status=200)
     else:
         return HttpResponse("Hello, world. This is the bot webhook endpoint.")
@@ -413,6 +707,8 @@ async def webhook(request):
 
 # Register handlers with the application
 application.add_handler(CommandHandler("start", start))
+application.add_handler(CommandHandler("history", history))
+application.add_handler(CommandHandler("resend", resend))
 application.add_handler(CallbackQueryHandler(button_handler))
 
 application.add_handler(MessageHandler(filters.PHOTO, handle_image))
@@ -13,4 +13,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'telegramOAHelper.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Telegram updates take a lightweight route that skips Django's middleware;
+# imported here because it needs the settings configured above.
+from TelegramBot.fastpath import webhook_fast_path  # noqa: E402
+
+application = webhook_fast_path(django_application)